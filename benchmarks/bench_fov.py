@@ -0,0 +1,54 @@
+#! /usr/bin/python
+"""
+bench_fov.py: Compare the field of view engines.
+
+Builds a world headlessly, then computes the visible set from every passable tile
+with both the "raycast" flood and the "shadowcast" engine, reporting the time taken,
+how closely the results agree, and how many visibility pairs are asymmetric.
+
+Usage: python benchmarks/bench_fov.py [coarse_w coarse_h] [seed]
+"""
+
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import game, fov
+
+def engines(w):
+	return [
+		("raycast", w.raycast_visible_set),
+		("shadowcast", lambda xy: fov.shadowcast(xy, w.cells.basic, w.w, w.h, game.Tile.TRANSPARENT)),
+	]
+
+def count_asymmetric(sets):
+	asymmetric = 0
+	for a, seen in sets.iteritems():
+		for b in seen:
+			if b in sets and a not in sets[b]:
+				asymmetric += 1
+	return asymmetric
+
+def main():
+	args = sys.argv[1:]
+	coarse_w, coarse_h = map(int, args[:2]) if len(args) >= 2 else (35, 25)
+	seed = int(args[2]) if len(args) >= 3 else 1
+	game.setup_headless()
+	random.seed(seed)
+	w = game.make_world(coarse_w, coarse_h)
+	origins = [xy for xy in w.cells if w.is_passable(xy, doors_count=False)]
+	print "World %ix%i (seed %i), %i passable origins" % (coarse_w, coarse_h, seed, len(origins))
+	results = {}
+	for name, engine in engines(w):
+		start = time.time()
+		sets = results[name] = dict((xy, engine(xy)) for xy in origins)
+		elapsed = time.time() - start
+		print "  %-10s %8.3fs  %7.1f us/origin  mean visible %6.1f  asymmetric pairs %i" % (
+			name, elapsed, 1e6 * elapsed / len(origins),
+			sum(map(len, sets.itervalues())) / float(len(sets)), count_asymmetric(sets))
+	old, new = results["raycast"], results["shadowcast"]
+	identical = sum(old[xy] == new[xy] for xy in origins)
+	jaccard = sum(len(old[xy] & new[xy]) / float(len(old[xy] | new[xy])) for xy in origins) / len(origins)
+	print "  identical sets: %i/%i, mean Jaccard similarity %.3f" % (identical, len(origins), jaccard)
+
+if __name__ == "__main__":
+	main()
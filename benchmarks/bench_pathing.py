@@ -0,0 +1,95 @@
+#! /usr/bin/python
+"""
+bench_pathing.py: Measure the per-turn pathing cost.
+
+Every turn, World.time_step updates the pathing map from the player that monsters walk along.
+This times that search, and the step count search from world generation, using both
+the deque based searches in pathing.py and the Queue.Queue searches they replaced.
+It then walks the player along the winning path, comparing a full pathing map out to every
+monster each turn with the player-rooted DistanceField that is only expanded as far as the
+aggroed monsters need.
+
+Usage: python benchmarks/bench_pathing.py [coarse_w coarse_h] [seed]
+"""
+
+import os, sys, time, random, Queue
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import game, pathing
+from benchutil import best_of
+
+def queue_pathing_map(w, source, points_to_include, doors_count=True):
+	# The search World.build_pathing_map used to do, kept here for comparison.
+	parent = {}
+	queue = Queue.Queue()
+	queue.put((None, source))
+	points_to_include = set(points_to_include)
+	while points_to_include and not queue.empty():
+		prev, xy = queue.get()
+		if xy in parent: continue
+		parent[xy] = prev
+		if xy in points_to_include:
+			points_to_include.remove(xy)
+		neighbors = w.get_neighbors(xy)
+		random.shuffle(neighbors)
+		for n in neighbors:
+			if w.is_passable(n, doors_count=doors_count):
+				queue.put((xy, n))
+	return parent
+
+def queue_step_counts(w, start, doors_count=True):
+	steps = {}
+	queue = Queue.Queue()
+	queue.put((start, 0))
+	while not queue.empty():
+		loc, count = queue.get()
+		if loc in steps:
+			continue
+		steps[loc] = count
+		for n in w.get_neighbors(loc):
+			if w.is_passable(n, doors_count=doors_count):
+				queue.put((n, count+1))
+	return steps
+
+def main():
+	args = sys.argv[1:]
+	coarse_w, coarse_h = map(int, args[:2]) if len(args) >= 2 else (35, 25)
+	seed = int(args[2]) if len(args) >= 3 else 1
+	game.setup_headless()
+	random.seed(seed)
+	w = game.make_world(coarse_w, coarse_h)
+	targets = [m.xy for m in w.monsters]
+	print "World %ix%i (seed %i), %i monsters" % (coarse_w, coarse_h, seed, len(targets))
+	# Both searches must agree exactly, given the same random state.
+	random.seed(seed)
+	old = queue_pathing_map(w, w.player.xy, targets, doors_count=False)
+	random.seed(seed)
+	new = w.build_pathing_map(w.player.xy, targets, doors_count=False)
+	assert old == new, "pathing maps differ"
+	assert queue_step_counts(w, w.start_loc) == pathing.step_counts(w.cells, game.Tile.PASSABLE[True], w.start_loc), "step counts differ"
+	for name, old_f, new_f, repeats in [
+		("per-turn pathing map", lambda: queue_pathing_map(w, w.player.xy, targets, doors_count=False),
+			lambda: w.build_pathing_map(w.player.xy, targets, doors_count=False), 20),
+		("step counts", lambda: queue_step_counts(w, w.start_loc),
+			lambda: pathing.step_counts(w.cells, game.Tile.PASSABLE[True], w.start_loc), 20),
+	]:
+		before, after = best_of(old_f, repeats), best_of(new_f, repeats)
+		print "  %-22s Queue.Queue %8.3f ms   deque %8.3f ms   (%.1fx)" % (name, 1e3*before, 1e3*after, before/after)
+	# Walk the winning path, with the monsters near the player aggroed.
+	walk = w.shortest_winning_path[:200]
+	full = field = 0.0
+	for xy in walk:
+		near = pathing.step_counts(w.cells, game.Tile.PASSABLE[False], xy)
+		aggroed = [m.xy for m in w.monsters if near.get(m.xy, 1000) <= 10]
+		start = time.time()
+		parent = w.build_pathing_map(xy, targets, doors_count=False)
+		for m in aggroed: parent[m]
+		full += time.time() - start
+		start = time.time()
+		distances = pathing.DistanceField(w.cells, game.Tile.PASSABLE[False], xy)
+		for m in aggroed: distances[m]
+		field += time.time() - start
+	print "  %-22s full map   %8.3f ms   field %8.3f ms   (%.1fx, over %i turns)" % ("per-turn while walking", 1e3*full/len(walk), 1e3*field/len(walk), full/field, len(walk))
+
+if __name__ == "__main__":
+	main()
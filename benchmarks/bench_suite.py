@@ -0,0 +1,120 @@
+#! /usr/bin/python
+"""
+bench_suite.py: Time world generation, pathing, field of view and rendering across world sizes.
+
+For each world size, in a fresh process (so that the memory figures of one size don't carry over to the next):
+	build        World.build_world, from the same seed each time
+	abridged     World.build_world_abridged
+	pathing      World.build_pathing_map from the start, out to every passable cell
+	visible_set  World.visible_set from every passable cell, starting from an empty memo
+	pprint       World.pprint into an off-screen buffer: a full redraw, and a redraw of everything being dirty
+Timings are the best of several runs, to cut down on noise. Memory is given as the size of the world
+(everything it references, found through the garbage collector) and the peak resident size of the process.
+
+Usage: python benchmarks/bench_suite.py [--sizes 15x13,35x25,55x35,150x100] [--seed N] [--repeats N] [--json PATH]
+"""
+
+import os, sys, random, gc, json, types, resource, multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import game, pathing
+from benchutil import best_of
+
+DEFAULT_SIZES = "15x13,35x25,55x35,150x100"
+# Shared by every world, so not counted towards the size of one.
+SHARED_TYPES = (types.ModuleType, types.ClassType, type, types.FunctionType, types.BuiltinFunctionType)
+
+class BufferScreen(game.NullScreen):
+	# An off-screen stand-in for the world pad, keeping the last character drawn at each position.
+	def __init__(self):
+		game.NullScreen.__init__(self)
+		self.buffer = {}
+	def addch(self, y, x, ch, *args):
+		self.buffer[y, x] = ch
+
+def deep_size(root):
+	# The bytes taken up by root and everything it references.
+	seen, stack, total = set(), [root], 0
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+			continue
+		seen.add(id(obj))
+		total += sys.getsizeof(obj)
+		stack.extend(gc.get_referents(obj))
+	return total
+
+def abridged_has_path(build):
+	# At some sizes, the abridged world's repeating pattern walls in the destination, and building it fails
+	# looking up the path there. Says whether the destination is reachable; any other failure is let through.
+	try:
+		build(quick=True)
+	except KeyError:
+		w = game.w
+		if w.dest_loc in pathing.step_counts(w.cells, game.Tile.PASSABLE[True], w.start_loc):
+			raise
+		return False
+	return True
+
+def bench_size(job):
+	# Run every benchmark on one world size. This runs in a worker process.
+	(coarse_w, coarse_h), seed, repeats = job
+	results = {"size": "%ix%i" % (coarse_w, coarse_h)}
+	def build(quick=False):
+		random.seed(seed)
+		return game.make_world(coarse_w, coarse_h, quick=quick)
+	results["build"] = best_of(build, repeats)
+	if abridged_has_path(build):
+		results["abridged"] = best_of(lambda: build(quick=True), repeats)
+	else:
+		results["abridged"] = None
+	w = build()
+	results["cells"] = w.w * w.h
+	results["world_bytes"] = deep_size(w)
+	targets = [xy for xy in w.steps]
+	results["passable"] = len(targets)
+	results["pathing"] = best_of(lambda: w.build_pathing_map(w.start_loc, targets), repeats)
+	def visible_sets():
+		w.visible_memo.clear()
+		for xy in targets:
+			w.visible_set(xy)
+	results["visible_set"] = best_of(visible_sets, repeats)
+	game.world_pad = BufferScreen()
+	w.revealed |= w.cells
+	results["pprint_full"] = best_of(lambda: w.pprint(everything=True), repeats)
+	def redraw_dirty():
+		w.full_rerender()
+		w.pprint()
+	results["pprint_dirty"] = best_of(redraw_dirty, repeats)
+	results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return results
+
+def main():
+	sizes = [tuple(map(int, size.split("x"))) for size in game.get_option("--sizes", DEFAULT_SIZES).split(",")]
+	seed = int(game.get_option("--seed", 1))
+	repeats = int(game.get_option("--repeats", 3))
+	print "Seed %i, best of %i runs" % (seed, repeats)
+	print "%-9s %10s %10s %10s %10s %12s %10s %10s %12s %10s" % ("size", "build", "abridged", "pathing", "vis/cell",
+		"visible_set", "pprint", "dirty", "world", "peak rss")
+	# A fresh process for each size, so the peak memory use of each is its own.
+	pool = multiprocessing.Pool(1, game.setup_headless, maxtasksperchild=1)
+	all_results = []
+	try:
+		for results in pool.imap(bench_size, [(size, seed, repeats) for size in sizes]):
+			all_results.append(results)
+			abridged = "n/a" if results["abridged"] is None else "%.3fs" % results["abridged"]
+			print "%-9s %9.3fs %10s %8.2fms %8.1fus %11.3fs %8.2fms %8.2fms %10.1fMB %8.1fMB" % (results["size"],
+				results["build"], abridged, 1e3*results["pathing"], 1e6*results["visible_set"]/results["passable"],
+				results["visible_set"], 1e3*results["pprint_full"], 1e3*results["pprint_dirty"],
+				results["world_bytes"]/1e6, results["peak_rss_kb"]/1e3)
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+	if game.get_option("--json"):
+		with open(game.get_option("--json"), "w") as f:
+			json.dump({"seed": seed, "repeats": repeats, "results": all_results}, f, indent=2, sort_keys=True, separators=(",", ": "))
+			f.write("\n")
+
+if __name__ == "__main__":
+	main()
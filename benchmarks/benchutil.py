@@ -0,0 +1,15 @@
+"""
+benchutil.py: Helpers shared by the benchmarks.
+"""
+
+import time
+
+def best_of(f, repeats):
+	# Time f, taking the best of several runs to cut down on noise.
+	best = None
+	for i in xrange(repeats):
+		start = time.time()
+		f()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
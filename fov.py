@@ -0,0 +1,121 @@
+"""
+fov.py: Field of view computation.
+
+Implements symmetric shadowcasting (as described by Albert Ford in "Symmetric Shadowcasting").
+The area around the origin is split into four quadrants, each of which is scanned row by row,
+narrowing the range of visible columns whenever a wall casts a shadow. Each visible cell is visited
+once per quadrant it lies in, rather than once per cell along a ray to it.
+
+The results are symmetric: a floor cell A can see a floor cell B exactly when B can see A.
+Walls bounding the visible area are visible, just like in World.ray_is_clear.
+
+Single lines of sight (as used by World.ray_is_clear, for the raycast engine) are walked along rays that are
+worked out once per grid, and kept in a RayTable.
+"""
+
+import math
+
+# Each quadrant is given as (row_dx, row_dy, col_dx, col_dy), mapping a (depth, column)
+# pair within the quadrant to the offset depth*row + column*col from the origin.
+QUADRANTS = (
+	(0, -1, 1, 0), # North
+	(0, 1, 1, 0),  # South
+	(1, 0, 0, 1),  # East
+	(-1, 0, 0, 1), # West
+)
+
+def shadowcast(origin, basic, width, height, transparent):
+	# basic is a flat array of tile types indexed by y*width+x, and transparent[t] says whether type t can be seen through.
+	# Returns the set of visible (x, y) cells. Cells off the edge of the grid are treated as opaque and never returned.
+	ox, oy = origin
+	visible = set([origin])
+	for row_dx, row_dy, col_dx, col_dy in QUADRANTS:
+		# Rows left to scan, as (depth, start_num, start_den, end_num, end_den).
+		# The slopes are kept as exact fractions with positive denominators, to avoid floating point edge cases.
+		rows = [(1, -1, 1, 1, 1)]
+		while rows:
+			depth, start_num, start_den, end_num, end_den = rows.pop()
+			# Round the start slope half up and the end slope half down to find the columns in this row.
+			min_col = (2*depth*start_num + start_den) // (2*start_den)
+			max_col = -((end_den - 2*depth*end_num) // (2*end_den))
+			prev_opaque = None
+			for col in xrange(min_col, max_col+1):
+				x = ox + row_dx*depth + col_dx*col
+				y = oy + row_dy*depth + col_dy*col
+				if 0 <= x < width and 0 <= y < height:
+					opaque = not transparent[basic[y*width+x]]
+					# Walls are always seen, but floors only if their center lies within the visible slopes.
+					# (This is what makes the algorithm symmetric.)
+					if opaque or (col*start_den >= depth*start_num and col*end_den <= depth*end_num):
+						visible.add((x, y))
+				else:
+					opaque = True
+				if prev_opaque and not opaque:
+					# Coming out of a shadow, so narrow the start of the visible range.
+					start_num, start_den = 2*col - 1, 2*depth
+				elif prev_opaque is False and opaque:
+					# Going into a shadow, so the visible range up to here continues on the next row.
+					rows.append((depth+1, start_num, start_den, 2*col - 1, 2*depth))
+				prev_opaque = opaque
+			if prev_opaque is False:
+				rows.append((depth+1, start_num, start_den, end_num, end_den))
+	return visible
+
+def ray(dx, dy, width):
+	# The cells a line of sight passes through on its way to the cell (dx, dy) away, not counting either end,
+	# as flat offsets (dy*width+dx) from where it starts, in order.
+	# A ray steps a unit length at a time, rounding to the nearest cell. (Rounding the offsets along the ray
+	# gives the same cells as rounding the absolute positions did: across a 301x201 grid, the offsets never come
+	# within 1e-8 of a rounding boundary, far more than the floating point error.)
+	offsets = []
+	norm = (dx**2.0 + dy**2.0)**0.5
+	unit = dx/norm, dy/norm
+	for c in xrange(int(norm)+1):
+		x, y = int(math.floor(0.5 + unit[0] * c)), int(math.floor(0.5 + unit[1] * c))
+		offset = y*width + x
+		if (x, y) != (0, 0) and (x, y) != (dx, dy) and offset not in offsets[-1:]:
+			offsets.append(offset)
+	return tuple(offsets)
+
+class RayTable:
+	# The rays walked by line_of_sight on one grid, by (dx, dy). Each is computed the first time it is needed.
+	# A table belongs to one grid (e.g., to a World), so it goes when the grid does. Only rays that fit in the grid,
+	# give or take the one cell past its edge that a flood out from a cell might look at, are kept. That makes at most
+	# (2w+1)*(2h+1) of them, each no longer than the grid's diagonal; any others are computed every time.
+	def __init__(self, width, height):
+		self.width, self.height = width, height
+		self.rays = {}
+
+	def get(self, dx, dy):
+		offsets = self.rays.get((dx, dy))
+		if offsets is None:
+			offsets = ray(dx, dy, self.width)
+			if abs(dx) <= self.width and abs(dy) <= self.height:
+				self.rays[dx, dy] = offsets
+		return offsets
+
+def line_of_sight(a, b, basic, rays, transparent):
+	# Says whether every cell strictly between a and b along the ray from a to b can be seen through.
+	# rays is the RayTable for the grid that basic holds the tiles of.
+	if a == b: return True
+	width = rays.width
+	if b[0] < 0 or b[1] < 0:
+		return traced_line_of_sight(a, b, basic, width, transparent)
+	start = a[1]*width + a[0]
+	for offset in rays.get(b[0] - a[0], b[1] - a[1]):
+		if not transparent[basic[start + offset]]:
+			return False
+	return True
+
+def traced_line_of_sight(a, b, basic, width, transparent):
+	# Like line_of_sight, but steps along the float ray directly. Past the top or left edge of the grid,
+	# this rounds toward zero rather than down, so line_of_sight uses it for cells out there.
+	delta = b[0] - a[0], b[1] - a[1]
+	norm = (delta[0]**2.0 + delta[1]**2.0)**0.5
+	unit = delta[0]/norm, delta[1]/norm
+	for c in xrange(0, int(norm)+1):
+		xy = int(a[0] + 0.5 + unit[0] * c), int(a[1] + 0.5 + unit[1] * c)
+		if xy == a or xy == b: continue
+		if not transparent[basic[xy[1]*width+xy[0]]]:
+			return False
+	return True
@@ -1,17 +1,207 @@
 #! /usr/bin/python
 
-import math, random, time, sys, Queue
+import math, random, time, sys, os, collections, hashlib, itertools, gc, heapq, binascii, string, bisect, json
 import curses, curses.wrapper
 
 from keymap import keymap
+import fov, pathing, snapshot
+# NumPy is optional: without it, world generation sticks to the plain Python passes.
+try:
+	import npgen
+except ImportError:
+	npgen = None
 
 colors = [chr(i) for i in xrange(9)]
 gray, blue, green, red, purple, teal, yellow, foggy, player_color = colors
 
 __ = gray + " "
 
-class Thing:
+# Screen state. These are filled in by main() for a real terminal, or by setup_headless()
+# for running the engine with no TTY. (Batch simulation, benchmarks, etc.)
+headless = False
+stdscr = world_pad = info_pane = None
+# If set, a file that every key read is written to. (See --record, and replay.py)
+key_log = None
+screen_height, screen_width = 24, 80
+color_mapping = {}
+g = w = None
+
+class HeadlessInputExhausted(Exception):
+	# Raised when a headless run asks for more input than was injected.
+	pass
+
+class NullScreen:
+	# A stand-in for a curses window in headless mode.
+	# All drawing is discarded, and keys are read from an injected sequence instead of the keyboard.
+	def __init__(self, keys=(), size=(24, 80)):
+		self.keys = list(keys)
+		self.size = size
+	def getmaxyx(self):
+		return self.size
+	def getch(self, *args):
+		if not self.keys:
+			raise HeadlessInputExhausted()
+		key = self.keys.pop(0)
+		if isinstance(key, str): key = ord(key)
+		return key
+	def getstr(self, *args):
+		# Like curses, read characters until enter is hit.
+		chars = []
+		while True:
+			key = self.getch()
+			if key in (10, 13): break
+			chars.append(chr(key))
+		return "".join(chars)
+	def addstr(self, *args): pass
+	def addch(self, *args): pass
+	def refresh(self, *args): pass
+	def move(self, *args): pass
+	def attron(self, *args): pass
+	def attroff(self, *args): pass
+	def keypad(self, *args): pass
+
+class RecordingScreen:
+	# Wraps a curses window, writing each key read from it to key_log, one key code per line.
+	def __init__(self, window):
+		self.window = window
+	def __getattr__(self, name):
+		return getattr(self.window, name)
+	def record(self, key):
+		key_log.write("%i\n" % key)
+		key_log.flush()
+	def getch(self, *args):
+		key = self.window.getch(*args)
+		self.record(key)
+		return key
+	def getstr(self, *args):
+		string = self.window.getstr(*args)
+		# Record it as the keys that were typed, so that NullScreen.getstr can read it back.
+		for c in string:
+			self.record(ord(c))
+		self.record(10)
+		return string
+
+def color_attr(color):
+	# The curses attribute for one of our color codes. (Always plain in headless mode.)
+	if headless:
+		return 0
+	return curses.color_pair(color_mapping[color])
+
+class Animation:
+	# Paces the frames of animations (attacks, scrolls and so on) on a frame clock.
+	# Each frame is held until its time is up, counted from when the previous frame's time was up,
+	# so the time spent drawing doesn't add on to the animation. While waiting, the keyboard is watched:
+	# a key press skips the rest of the animations until the next action, and the key is then read as usual.
+	# Headless runs don't wait around for anyone to watch.
+	def __init__(self):
+		# Every frame time is divided by this. (0 turns animations off.)
+		self.speed = 1.0
+		self.start()
+
+	def start(self):
+		# Called before each player action, so that a skip only lasts for the animations it interrupted.
+		self.deadline = None
+		self.skipping = False
+
+	def frame(self, seconds):
+		# Hold what has been drawn for the given time.
+		if headless or self.skipping or self.speed <= 0:
+			return
+		now = time.time()
+		if self.deadline is None or self.deadline < now:
+			self.deadline = now
+		self.deadline += seconds / self.speed
+		# Read from the window itself, so that a recording doesn't get the key twice.
+		window = getattr(stdscr, "window", stdscr)
+		try:
+			while now < self.deadline:
+				window.timeout(int(math.ceil(1000 * (self.deadline - now))))
+				key = window.getch()
+				if key != -1:
+					curses.ungetch(key)
+					self.skipping = True
+					return
+				now = time.time()
+		finally:
+			window.timeout(-1)
+
+animation = Animation()
+
+class Profiler:
+	# Counts the calls to, and adds up the wall time spent in, the parts of the game listed in PROFILED_METHODS,
+	# along with the phases of long jobs like world building, for the report written by --profile.
+	# Nothing is wrapped until it is enabled, so the game runs at full speed without it.
+	# The times are inclusive: a pprint made during a time_step counts towards both.
+	def __init__(self):
+		self.enabled = False
+		self.stats = {}
+		# The names of the methods already being timed.
+		self.watched = set()
+		# The phase being timed, and when it started.
+		self.current_phase = None
+
+	def enable(self):
+		if self.enabled: return
+		self.enabled = True
+		for cls, name in PROFILED_METHODS:
+			self.watch(cls, name)
+
+	def watch(self, cls, name):
+		# Start timing a method (if it isn't already), whether or not profiling is enabled.
+		# Returns the name its stats are kept under.
+		key = "%s.%s" % (cls.__name__, name)
+		if key not in self.watched:
+			self.watched.add(key)
+			setattr(cls, name, self.wrap(key, getattr(cls, name)))
+		return key
+
+	def wrap(self, name, method):
+		def timed(*args, **kwargs):
+			start = time.time()
+			try:
+				return method(*args, **kwargs)
+			finally:
+				self.add(name, time.time() - start)
+		return timed
+
+	def add(self, name, seconds):
+		entry = self.stats.setdefault(name, [0, 0.0])
+		entry[0] += 1
+		entry[1] += seconds
+
+	def phase(self, name):
+		# Ends the phase being timed (if any), and starts timing the next one (unless name is None).
+		if not self.enabled: return
+		now = time.time()
+		if self.current_phase is not None:
+			current, start = self.current_phase
+			self.add(current, now - start)
+		self.current_phase = None if name is None else (name, now)
+
+	def report(self):
+		sections = {}
+		for name, (calls, seconds) in self.stats.iteritems():
+			sections[name] = {"calls": calls, "seconds": seconds, "ms_per_call": 1e3 * seconds / calls}
+		report = {"sections": sections}
+		if w is not None and hasattr(w, "visible_memo"):
+			memo = w.visible_memo
+			lookups = memo.hits + memo.misses
+			report["visible_memo"] = {"hits": memo.hits, "misses": memo.misses, "size": len(memo), "max_size": memo.max_size,
+				"hit_rate": memo.hits / float(lookups) if lookups else None}
+		return report
+
+	def write(self, path):
+		with open(path, "w") as f:
+			json.dump(self.report(), f, indent=2, sort_keys=True, separators=(",", ": "))
+			f.write("\n")
+
+profiler = Profiler()
+
+class Thing(object):
 	# A Thing is something that goes on a tile, like a gold chest. Generally speaking Things allow for some user interaction. Monsters are not Things.
+	# Things, monsters and the player list their fields in __slots__, so there's no dict per instance. (A world has thousands of them.)
+	# A subclass that stores nothing new should still say __slots__ = (), or its instances get a dict anyway.
+	__slots__ = ("should_cull",)
 	display_string = __ + yellow + "?"
 	name = "Generic Thing"
 	description = "It is impressively generic."
@@ -27,6 +217,7 @@ class Thing:
 		return ["Thing:", " It's... a thing, I guess."]
 
 class Chest(Thing):
+	__slots__ = ("is_super", "gold_content", "inventory")
 	display_string = __ + yellow + "g"
 	name = "Treasure Chest"
 	description = "I wonder what's inside!"
@@ -47,13 +238,13 @@ class Chest(Thing):
 			value_rating = random.randint(value_rating/3, value_rating)
 		starting = value_rating
 		self.inventory = {}
+		loot_table = get_loot_table()
 		while value_rating > starting/2 and sum(self.inventory.values()) < w.MAX_CHEST_CONTENTS:
 			# Randomly, sometimes truncate the item list.
 			if random.random() <= 0.25:
 				break
-			available_items = [item for item in item_type_list if item.value <= value_rating]
-			if not available_items: break
-			new = random.choice(available_items)
+			new = loot_table.choice(value_rating)
+			if new is None: break
 			if new not in self.inventory: self.inventory[new] = 0
 			self.inventory[new] += 1
 			value_rating -= new.value
@@ -81,6 +272,7 @@ class Chest(Thing):
 
 class Bloodstone(Thing):
 	# Sacrifice things, and get things back.
+	__slots__ = ()
 	GOLD_EFFICIENCY = 0.1 # Gold in * efficiency = max value of item out
 	ITEM_EFFICIENCY = 0.7 # Ditto but when sacrificing an item rather than gold
 	FAIL_PROB = 0.1
@@ -91,18 +283,19 @@ class Bloodstone(Thing):
 	
 	def produce_item(self, value):
 		# For now, just pick an item whose value is less than the input.
-		available_items = [item for item in item_type_list if item.value <= value]
-		if len(available_items) == 0 or random.random() < self.FAIL_PROB:
+		loot_table = get_loot_table()
+		if loot_table.count(value) == 0 or random.random() < self.FAIL_PROB:
 			return None
 		else:
-			distrib = {}
-			for item in available_items:
-				# The following is a dumb way to see if something is cursed. TODO: Modify the ItemModifier class so there's a better way to see if something is cursed.
-				if "cursed-" in item.name:
-					distrib[item] = self.CURSED_WEIGHT
-				else:
-					distrib[item] = 1.0
-			return sample_from_distribution(distrib)
+			return loot_table.sample(value)
+
+	@classmethod
+	def item_weight(cls, item):
+		# How likely the altar is to produce an item, relative to the others it could produce.
+		# The following is a dumb way to see if something is cursed. TODO: Modify the ItemModifier class so there's a better way to see if something is cursed.
+		if "cursed-" in item.name:
+			return cls.CURSED_WEIGHT
+		return 1.0
 
 	def info_pane_messages(self):
 		return ["Bloodstone Altar", " (%s to make a sacrifice)" % chr(keymap['use_thing'])]
@@ -141,7 +334,8 @@ class Bloodstone(Thing):
 			player.inventory[prize] += 1
 
 
-class Combatant:
+class Combatant(object):
+	__slots__ = ("hp", "mp", "stun")
 	# Armor works as straight damage reduction, with a minimum of 1 damage per hit.
 	armor = 0
 	max_hp = max_mp = 0
@@ -155,13 +349,15 @@ class Combatant:
 		# A convenience call for animating attacks.
 		w.pprint()
 		g.refresh_screen()
-		time.sleep(0.1)
+		animation.frame(0.1)
 		w.print_pattern(a.xy, attacker_graphic)
 		w.print_pattern(b.xy, target_graphic)
+		w.dirty.add(a.xy)
+		w.dirty.add(b.xy)
 		g.refresh_screen()
-		time.sleep(0.1)
+		animation.frame(0.1)
 		w.pprint()
-		time.sleep(0.1)
+		animation.frame(0.1)
 
 	def take_hit(self, attack):
 		damage = attack["damage"]
@@ -184,33 +380,65 @@ class Combatant:
 	def should_die(self):
 		return self.hp <= 0
 
-enemy_type_distribution = {}
+# Kept in registration order (rather than the arbitrary order of a dict keyed by class), so spawns are reproducible from a seed.
+enemy_type_distribution = collections.OrderedDict()
 def enemy(cls):
 	enemy_type_distribution[cls] = cls.spawn_weight
 	return cls
 
-def sample_from_distribution(distrib):
-	total_weight = sum(distrib.itervalues())
-	r = random.uniform(0,total_weight)
-	for key in distrib:
-		r -= distrib[key]
-		if r <= 0:
-			return key
+class ThresholdTable:
+	# Picks keys at or below a threshold (of value, difficulty and so on). The keys are kept sorted by level (ties in
+	# their original order), with the running totals of their weights alongside, so the keys under a threshold are
+	# always a prefix: finding it is a bisection on the levels, and a weighted draw from it is a bisection on the totals.
+	def __init__(self, keys, level, weight):
+		self.keys = sorted(keys, key=level)
+		self.size = len(self.keys)
+		self.levels = map(level, self.keys)
+		self.totals, total = [], 0
+		for key in self.keys:
+			total += weight(key)
+			self.totals.append(total)
+
+	def count(self, threshold):
+		# How many keys have a level of at most threshold.
+		return bisect.bisect_right(self.levels, threshold)
+
+	def choice(self, threshold):
+		# One of the keys at or below threshold, all equally likely, or None if there are none.
+		n = self.count(threshold)
+		return self.keys[int(random.random() * n)] if n else None
+
+	def sample(self, threshold):
+		# One of the keys at or below threshold, in proportion to their weights. Returns None if there are none.
+		# (A random number is still drawn.)
+		n = self.count(threshold)
+		i = bisect.bisect_left(self.totals, random.uniform(0, self.totals[n-1] if n else 0), 0, n)
+		return self.keys[i] if i < n else None
+
+enemy_table = None
+def get_enemy_table():
+	# The enemy types by difficulty, weighted by how often they spawn. Rebuilt whenever more enemy types have been registered.
+	global enemy_table
+	if enemy_table is None or enemy_table.size != len(enemy_type_distribution):
+		enemy_table = ThresholdTable(enemy_type_distribution.keys(), lambda enemy: enemy.difficulty, enemy_type_distribution.get)
+	return enemy_table
 
 def generate_enemy(xy, tiles=1, steps=1):
 	difficulty_rating = (steps * tiles) / 1000.0
-	available_enemy_distribution = dict((enemy, enemy_type_distribution[enemy]) for enemy in enemy_type_distribution if enemy.difficulty <= difficulty_rating)
-	enemy_type = sample_from_distribution(available_enemy_distribution)
+	enemy_type = get_enemy_table().sample(difficulty_rating)
 	# Determine whether or not to place a hidden enemy.
 	if random.random() <= enemy_type.hidden_probability:
 		# Place a hidden enemy.
-		w.dynamic_objects.append(HiddenEnemy(xy, enemy_type))
+		w.add_dynamic_object(HiddenEnemy(xy, enemy_type))
 	else:
 		# Otherwise, simply place the enemy.
-		w.monsters.append(enemy_type(xy))
+		w.add_monster(enemy_type(xy))
+
+class DynamicObject(object):
+	__slots__ = ("do_cull",)
 
-class DynamicObject:
-	do_cull = False
+	def __init__(self):
+		self.do_cull = False
 
 	def to_string(self):
 		return red + "D" + red + "O"
@@ -219,15 +447,21 @@ class DynamicObject:
 		return self.do_cull
 
 class HiddenEnemy(DynamicObject):
+	__slots__ = ("xy", "enemy_type", "steps_required_to_unhide")
 	# The player must be visible, and at least this many steps (or as many as are visible) ahead of the player.
-	steps_required_to_unhide = 3
+	STEPS_REQUIRED_TO_UNHIDE = 3
 
-	def __init__(self, xy, enemy_type):
+	def __init__(self, xy, enemy_type, steps_required_to_unhide=None):
+		DynamicObject.__init__(self)
 		self.xy, self.enemy_type = xy, enemy_type
+		# (A saved game already knows how many steps are required.)
+		if steps_required_to_unhide is not None:
+			self.steps_required_to_unhide = steps_required_to_unhide
+			return
 		max_visible_steps = max(w.steps[loc]-w.steps[self.xy] for loc in w.visible_set(self.xy) if loc in w.steps)
 		# Sometimes, no cell is visible with enough steps.
 		# In this case, simply require as many steps as required to the furthest away visible cell.
-		self.steps_required_to_unhide = min(max_visible_steps, self.steps_required_to_unhide)
+		self.steps_required_to_unhide = min(max_visible_steps, self.STEPS_REQUIRED_TO_UNHIDE)
 
 	def to_string(self):
 		return __ + __
@@ -240,14 +474,15 @@ class HiddenEnemy(DynamicObject):
 			monster = self.enemy_type(self.xy)
 			# Auto aggro unhidden enemies, and disable their deaggro.
 			monster.aggro = True
-			monster.deaggro_if_out_of_sight = False
+			monster.can_deaggro = False
 			# Prevent a freshly spawned enemy adjacent to the player
 			# from immediately attacking by stunning it for a round.
 			if self.steps_required_to_unhide <= 1 or monster.can_move_then_attack:
 				monster.stun = 1
-			w.monsters.append(monster)
+			w.add_monster(monster)
 
 class EnemyType(Combatant):
+	__slots__ = ("xy", "aggro", "moved_this_round", "can_deaggro")
 	display_string = red + "E" + red +"R"
 	name = "Generic Enemy"
 	description = "It's an enemy. What more do you want?"
@@ -279,6 +514,8 @@ class EnemyType(Combatant):
 		self.xy = xy
 		self.aggro = False
 		self.moved_this_round = False
+		# Starts out as deaggro_if_out_of_sight, but an enemy that jumps out of hiding never deaggroes.
+		self.can_deaggro = self.deaggro_if_out_of_sight
 
 	def do_ai(self):
 		# Check if stunned.
@@ -289,7 +526,7 @@ class EnemyType(Combatant):
 		# Check to see if we can see the player.
 		if w.player.xy in w.visible_set(self.xy):
 			self.aggro = True
-		elif self.deaggro_if_out_of_sight:
+		elif self.can_deaggro:
 			self.aggro = False
 		if not self.aggro: return
 		neighbors = w.get_neighbors(self.xy) + [self.xy]
@@ -298,7 +535,7 @@ class EnemyType(Combatant):
 			pass
 		# If we are aggroed, then plan the shortest path towards them, and start walking.
 		elif random.random() <= self.random_walk_probability:
-			neighbors = [n for n in neighbors if w.cells[n].is_passable(doors_count=False)]
+			neighbors = [n for n in neighbors if w.is_passable(n, doors_count=False)]
 			self.try_to_move_to(random.choice(neighbors))
 		else:
 			# Find the next step to take to get to the player.
@@ -317,15 +554,21 @@ class EnemyType(Combatant):
 		if self.has_melee_attack and (self.can_move_then_attack or not self.moved_this_round) and w.player.xy in w.get_neighbors(self.xy):
 			self.do_melee_attack(w.player, self.melee_attack)
 
+	def take_hit(self, attack):
+		Combatant.take_hit(self, attack)
+		# A stun has to wear off a turn at a time, so a sleeping monster that gets hit needs its turns back.
+		w.monster_scheduler.wake(self)
+
 	def try_to_move_to(self, xy):
 		if w.check_if_unoccupied_by_people(xy):
-			self.xy = xy
+			w.monster_index.move(self, xy)
 
 	def to_string(self):
 		return self.display_string
 
 @enemy
 class Gnat(EnemyType):
+	__slots__ = ()
 	display_string = teal + "\'" + __
 	name = "Cave Gnat"
 	description = "A big one, too. How irritating."
@@ -338,6 +581,7 @@ class Gnat(EnemyType):
 	melee_attack = {"damage": 1, "accuracy": 0.5}
 @enemy
 class Mosquito(EnemyType):
+	__slots__ = ()
 	display_string = teal + "\"" + __
 	name = "Mosquito"
 	description = "Kind of like a tiny vampire, if you think about it."
@@ -351,6 +595,7 @@ class Mosquito(EnemyType):
 
 @enemy
 class Zombie(EnemyType):
+	__slots__ = ()
 	display_string = teal + "z" + __
 	name = "Zombie"
 	description = "Braaaaaaains..."
@@ -365,6 +610,7 @@ class Zombie(EnemyType):
 
 @enemy
 class BigZombie(EnemyType):
+	__slots__ = ()
 	display_string = teal + "Z" + __
 	name = "Big Zombie"
 	description = "BRAAAAAAAINS..."
@@ -379,6 +625,7 @@ class BigZombie(EnemyType):
 
 @enemy
 class Ogre(EnemyType):
+	__slots__ = ()
 	display_string = teal + "O" + __
 	name = "Ogre"
 	description = "It's huge, and boy does it looks angry!"
@@ -391,12 +638,15 @@ class Ogre(EnemyType):
 	has_melee_attack = True
 	melee_attack = {"damage": 5}
 
-class Projectile:
+class Projectile(object):
+	__slots__ = ("xy", "target", "desc")
+
 	def __init__(self, xy, target, desc):
 		self.xy, self.target, self.desc = xy, target, desc
-		w.dynamic_objects.append(self)
+		w.add_dynamic_object(self)
 
-class Tile:
+class Tile(object):
+	__slots__ = ("basic", "contents", "steps_skipped")
 	TILE_STRINGS = [
 		__ + __,
 		gray+"\xff"+gray+"\xff",
@@ -417,11 +667,20 @@ class Tile:
 	ROOM = 6
 	MAGIC_BARRIER = 7
 	GLASS = 8
+	# Per-type lookup tables, so hot loops can test a tile with a single index and no allocation.
+	# Use as PASSABLE[doors_count][basic] and TRANSPARENT[basic].
+	PASSABLE = (
+		[b in (BLANK, ROOM, START, DESTINATION) for b in xrange(len(TILE_STRINGS))],
+		[b in (BLANK, DOOR, ROOM, MAGIC_BARRIER, START, DESTINATION) for b in xrange(len(TILE_STRINGS))],
+	)
+	TRANSPARENT = [b in (BLANK, ROOM, GLASS, START, DESTINATION) for b in xrange(len(TILE_STRINGS))]
+	# The contents of every empty tile, shared between them all. Assign a new list to put something on a tile.
+	NO_CONTENTS = ()
 
 	def __init__(self, basic):
 		# Store the basic type of the tile
 		self.basic = basic
-		self.contents = []
+		self.contents = self.NO_CONTENTS
 		# Some type dependent storage.
 		self.steps_skipped = None
 
@@ -434,13 +693,285 @@ class Tile:
 		return self.TILE_STRINGS[self.basic]
 
 	def is_passable(self, doors_count=True):
-		# Reject the door types if doors don't count.
-		if self.basic in [self.DOOR, self.MAGIC_BARRIER] and not doors_count:
-			return False
-		return self.basic in [self.BLANK, self.DOOR, self.ROOM, self.MAGIC_BARRIER, self.START, self.DESTINATION]
+		return self.PASSABLE[bool(doors_count)][self.basic]
 
 	def is_transparent(self):
-		return self.basic in [self.BLANK, self.ROOM, self.GLASS, self.START, self.DESTINATION]
+		return self.TRANSPARENT[self.basic]
+
+class Grid:
+	# Flat storage for the world map. Tile types live in a byte array indexed by y*w+x, and the
+	# rarely used per-tile data (contents and door values) live in sparse side tables keyed by the same index.
+	# Indexing with an (x, y) pair gives a TileView, so code written against Tile objects keeps working.
+	def __init__(self, w, h, fill=Tile.BLANK):
+		self.w, self.h = w, h
+		self.basic = bytearray([fill]) * (w*h)
+		self.contents = {}
+		self.steps_skipped = {}
+		# If set, called as on_change(xy, old_basic, new_basic) whenever a tile's type or contents change.
+		# (For a change of contents alone, old_basic and new_basic are the same.)
+		self.on_change = None
+
+	def store(self, i, basic):
+		# Every change of tile type goes through here, so that on_change sees it.
+		old = self.basic[i]
+		if old == basic: return
+		self.basic[i] = basic
+		if self.on_change is not None:
+			self.on_change(self.xy_of(i), old, basic)
+
+	def touch(self, i):
+		# Report a change of contents to on_change.
+		if self.on_change is not None:
+			self.on_change(self.xy_of(i), self.basic[i], self.basic[i])
+
+	def index(self, xy):
+		x, y = xy
+		# Behave like the dict of tiles this replaced, rather than silently wrapping around.
+		if not (0 <= x < self.w and 0 <= y < self.h):
+			raise KeyError(xy)
+		return y*self.w + x
+
+	def xy_of(self, index):
+		return index % self.w, index / self.w
+
+	def basic_at(self, xy):
+		return self.basic[self.index(xy)]
+
+	def set_basic(self, xy, basic):
+		# Change the tile type, keeping any contents.
+		self.store(self.index(xy), basic)
+
+	def reset(self, xy, basic):
+		# Equivalent to self[xy] = Tile(basic), but without allocating a Tile.
+		i = self.index(xy)
+		self.store(i, basic)
+		if self.contents.pop(i, None):
+			self.touch(i)
+		self.steps_skipped.pop(i, None)
+
+	def add_thing(self, xy, thing):
+		i = self.index(xy)
+		self.contents.setdefault(i, []).append(thing)
+		self.touch(i)
+
+	def __getitem__(self, xy):
+		return TileView(self, self.index(xy))
+
+	def __setitem__(self, xy, tile):
+		# Copy a freestanding Tile into the grid.
+		self.reset(xy, tile.basic)
+		view = self[xy]
+		view.contents = tile.contents
+		view.steps_skipped = tile.steps_skipped
+
+	def __contains__(self, xy):
+		return 0 <= xy[0] < self.w and 0 <= xy[1] < self.h
+
+	def __iter__(self):
+		for y in xrange(self.h):
+			for x in xrange(self.w):
+				yield x, y
+
+	def __len__(self):
+		return self.w * self.h
+
+	def iteritems(self):
+		for xy in self:
+			yield xy, self[xy]
+
+BINARY_DIGITS = string.maketrans("01", "\0\1")
+
+class CellSet:
+	# A set of grid cells, stored as the bits of an integer. Bit k stands for the cell with index base+k,
+	# where cells are indexed y*width+x, like in a Grid. The bits only span from the first cell in the set to the last,
+	# so a visible set takes a few hundred bytes, where a set of (x, y) tuples takes several kilobytes.
+	# Unions, intersections and differences are single integer operations.
+	# Cells off the width by height grid are never in the set: adding them does nothing.
+	def __init__(self, width, height, cells=()):
+		self.width, self.height = width, height
+		self.bits, self.base = self.pack(cells)
+
+	def pack(self, cells):
+		# Returns (bits, base) for an iterable of (x, y) cells, leaving out any off the grid.
+		# Given x is in range, y is in range just when the index is, so only the few sets that run off the top
+		# or the bottom need a second pass.
+		width, size = self.width, self.width*self.height
+		indices = [y*width+x for x, y in cells if 0 <= x < width]
+		if not indices:
+			return 0, 0
+		base, top = min(indices), max(indices)
+		if base < 0 or top >= size:
+			indices = [i for i in indices if 0 <= i < size]
+			if not indices:
+				return 0, 0
+			base, top = min(indices), max(indices)
+		buf = bytearray((top-base)/8 + 1)
+		for i in indices:
+			k = i - base
+			buf[k >> 3] |= 1 << (k & 7)
+		# Parse the bytes as one big number, most significant byte first.
+		buf.reverse()
+		return int(binascii.hexlify(buf), 16), base
+
+	def indices(self):
+		# The indices of the cells in the set, in increasing order.
+		bits, base = self.bits, self.base
+		if not bits:
+			return []
+		# In the reversed binary representation, character k is bit k. Turned into zero and one bytes,
+		# the characters can pick out the indices without a Python level loop.
+		digits = bin(bits)[:1:-1]
+		return list(itertools.compress(xrange(base, base+len(digits)), bytearray(digits.translate(BINARY_DIGITS))))
+
+	def __iter__(self):
+		width = self.width
+		return iter([(i % width, i / width) for i in self.indices()])
+
+	def __len__(self):
+		return bin(self.bits).count("1")
+
+	def __nonzero__(self):
+		return self.bits != 0
+
+	def __contains__(self, xy):
+		x, y = xy
+		if not (0 <= x < self.width and 0 <= y < self.height):
+			return False
+		k = y*self.width + x - self.base
+		return k >= 0 and (self.bits >> k) & 1 == 1
+
+	def add(self, xy):
+		x, y = xy
+		if not (0 <= x < self.width and 0 <= y < self.height):
+			return
+		i = y*self.width + x
+		if not self.bits:
+			self.base = i
+		elif i < self.base:
+			self.bits <<= self.base - i
+			self.base = i
+		self.bits |= 1 << (i - self.base)
+
+	def clear(self):
+		self.bits = self.base = 0
+
+	def copy(self):
+		result = CellSet(self.width, self.height)
+		result.bits, result.base = self.bits, self.base
+		return result
+
+	def aligned(self, other):
+		# Returns the bits of both sets relative to a common base, along with that base.
+		if not isinstance(other, CellSet):
+			other = CellSet(self.width, self.height, other)
+		if not self.bits:
+			return 0, other.bits, other.base
+		if not other.bits:
+			return self.bits, 0, self.base
+		base = min(self.base, other.base)
+		return self.bits << (self.base - base), other.bits << (other.base - base), base
+
+	def combine(self, other, op):
+		result = CellSet(self.width, self.height)
+		a, b, result.base = self.aligned(other)
+		result.bits = op(a, b)
+		return result
+
+	def __or__(self, other):
+		return self.combine(other, lambda a, b: a | b)
+
+	def __and__(self, other):
+		return self.combine(other, lambda a, b: a & b)
+
+	def __sub__(self, other):
+		return self.combine(other, lambda a, b: a & ~b)
+
+	def __ior__(self, other):
+		a, b, self.base = self.aligned(other)
+		self.bits = a | b
+		return self
+
+	update = __ior__
+
+	def __eq__(self, other):
+		a, b, base = self.aligned(other)
+		return a == b
+
+	def __ne__(self, other):
+		return not self == other
+
+class VisibilityCache:
+	# Memoizes visible sets by origin. At most max_size sets are kept, dropping the least recently used first.
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = collections.OrderedDict()
+		# How many lookups found a set, and how many didn't. (See --profile.)
+		self.hits = self.misses = 0
+
+	def get(self, origin):
+		reached = self.entries.pop(origin, None)
+		if reached is not None:
+			# Reinsert, to mark it as the most recently used.
+			self.entries[origin] = reached
+			self.hits += 1
+		else:
+			self.misses += 1
+		return reached
+
+	def __setitem__(self, origin, reached):
+		self.entries.pop(origin, None)
+		self.entries[origin] = reached
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+
+	def __contains__(self, origin):
+		return origin in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def invalidate(self, xy):
+		# The transparency of xy changed. A cell out of view can't change what an origin sees,
+		# so only the sets containing xy (including the one from xy itself) go stale.
+		for origin in [origin for origin, reached in self.entries.iteritems() if xy in reached]:
+			del self.entries[origin]
+
+	def clear(self):
+		self.entries.clear()
+
+class TileView(Tile):
+	# A handle onto one cell of a Grid, with the same interface as Tile.
+	# Reads and writes go straight through to the grid's storage.
+	# The contents of an empty cell read as Tile.NO_CONTENTS; use Grid.add_thing to put something there.
+	__slots__ = ("grid", "index")
+
+	def __init__(self, grid, index):
+		self.grid, self.index = grid, index
+
+	def get_basic(self):
+		return self.grid.basic[self.index]
+	def set_basic(self, basic):
+		self.grid.store(self.index, basic)
+	basic = property(get_basic, set_basic)
+
+	def get_contents(self):
+		return self.grid.contents.get(self.index, self.NO_CONTENTS)
+	def set_contents(self, contents):
+		if contents:
+			self.grid.contents[self.index] = contents
+		else:
+			self.grid.contents.pop(self.index, None)
+		self.grid.touch(self.index)
+	contents = property(get_contents, set_contents)
+
+	def get_steps_skipped(self):
+		return self.grid.steps_skipped.get(self.index)
+	def set_steps_skipped(self, steps_skipped):
+		if steps_skipped is None:
+			self.grid.steps_skipped.pop(self.index, None)
+		else:
+			self.grid.steps_skipped[self.index] = steps_skipped
+	steps_skipped = property(get_steps_skipped, set_steps_skipped)
 
 item_type_list = []
 def item(cls):
@@ -457,6 +988,14 @@ def get_item_type_by_name(name):
 		if item_type.name == name:
 			return item_type
 
+loot_table = None
+def get_loot_table():
+	# The item types by value, weighted for the Bloodstone. Rebuilt whenever more item types have been registered.
+	global loot_table
+	if loot_table is None or loot_table.size != len(item_type_list):
+		loot_table = ThresholdTable(item_type_list, lambda item: item.value, Bloodstone.item_weight)
+	return loot_table
+
 class ItemType:
 	name = "???"
 	description = "A non-descript item."
@@ -611,20 +1150,20 @@ class ScrollOfSeeing(ItemType):
 	rounds_to_use = 1
 
 	def activate(self):
-		locations = set((w.player.xy,))
+		locations = CellSet(w.w, w.h, [w.player.xy])
 		# Propagate vision a number of rounds.
 		# Run 2 rounds, except greater version gets run 3 rounds.
 		for rounds in xrange(2 + self.greater):
-			next_locations = set()
+			next_locations = CellSet(w.w, w.h)
 			for xy in locations:
-				if w.cells[xy].is_transparent():
-					next_locations |= set(i for i in w.visible_set(xy))
+				if w.is_transparent(xy):
+					next_locations |= w.visible_set(xy)
 			locations = next_locations
 			for xy in locations:
-				if not w.cells[xy].is_transparent(): continue
+				if not w.is_transparent(xy): continue
 				w.print_pattern(xy, blue+"\xff"+blue+"\xff")
 			g.refresh_screen()
-			time.sleep(0.4)
+			animation.frame(0.4)
 		w.revealed |= locations
 		w.dirty |= locations
 		return True
@@ -650,7 +1189,7 @@ class ScrollOfRevelation(ItemType):
 
 	def activate(self):
 		radius = 10 + self.greater * 5
-		already_hit = set()
+		already_hit = CellSet(w.w, w.h)
 		for r in xrange(radius):
 			w.pprint()
 			for dx in xrange(-radius, radius+1):
@@ -665,7 +1204,7 @@ class ScrollOfRevelation(ItemType):
 						w.dirty.add(xy)
 						already_hit.add(xy)
 			g.refresh_screen()
-			time.sleep(0.1)
+			animation.frame(0.1)
 		return True
 
 @item
@@ -717,18 +1256,17 @@ class ScrollOfTeleportation(ItemType):
 				w.revealed.add(xy)
 				w.dirty.add(xy)
 		g.refresh_screen()
-		time.sleep(0.4)
+		animation.frame(0.4)
 		# Next, show the player the destination area for a second,
 		# so he or she can see what is about to be blown away.
 		w.pprint()
 		g.refresh_screen()
-		time.sleep(1.0)
+		animation.frame(1.0)
 		for dx in (-1, 0, 1):
 			for dy in (-1, 0, 1):
 				if abs(dx) + abs(dy) > 1: continue
-				w.cells[dest_x+dx, dest_y+dy] = Tile(Tile.BLANK)
-		w.dirty.add(w.player.xy)
-		w.player.xy = dest_x, dest_y
+				w.cells.reset((dest_x+dx, dest_y+dy), Tile.BLANK)
+		w.move_player((dest_x, dest_y))
 		return True
 
 @item
@@ -761,8 +1299,7 @@ class AnkhOfRetreat(ItemType):
 				show_message("Cannot retreat to a magical area or into walls.")
 				continue
 			break
-		w.dirty.add(w.player.xy)
-		w.player.xy = result
+		w.move_player(result)
 		return True
 
 @item
@@ -799,12 +1336,11 @@ class BlinkPowder(ItemType):
 			result = get_location_selection("Blink where? (Must be within eye-sight.)", lambda xy: w.check_line_of_sight(w.player.xy, xy))
 			if not result: # Check for action cancelation.
 				return False
-			if not w.cells[result].is_passable(doors_count=False):
+			if not w.is_passable(result, doors_count=False):
 				show_message("Can only blink to passable terrain.")
 				continue
 			break
-		w.dirty.add(w.player.xy)
-		w.player.xy = result
+		w.move_player(result)
 		return True
 
 @item
@@ -903,11 +1439,9 @@ class MeleeWeapon(ItemType):
 
 	def activate(self, direction=None):
 		flag = False
-		for m in w.monsters:
-			# Check if our attack hits.
-			if m.xy == w.player.get_in_direction(direction):
-				w.player.do_melee_attack(m, self.melee_attack)
-				flag = True
+		for m in list(w.monster_index.at(w.player.get_in_direction(direction))):
+			w.player.do_melee_attack(m, self.melee_attack)
+			flag = True
 		return flag
 
 @item
@@ -938,6 +1472,8 @@ class Sword(MeleeWeapon):
 	rounds_to_use = 3
 
 class Player(Combatant):
+	__slots__ = ("xy", "gold", "inventory", "level", "xp", "max_xp", "max_hp", "max_mp", "fractional_mp")
+
 	def __init__(self):
 		self.xy = None
 		self.gold = 0
@@ -964,7 +1500,8 @@ class Player(Combatant):
 
 	def lookup_item_fuzzy(self, name):
 		matches = []
-		for itemtype, count in self.inventory.iteritems():
+		# Go in a fixed order, so that which of several matches gets used doesn't vary from run to run.
+		for itemtype, count in sorted(self.inventory.iteritems(), key=lambda x: (x[0].sort_index, x[0].name)):
 			if itemtype.name == name and count > 0:
 				return [itemtype] # Exact match
 			if name in itemtype.name and count > 0:
@@ -1000,7 +1537,7 @@ class Player(Combatant):
 					g.do_full_ui_update()
 					# If someone is aggroed, then let them take extra turns.
 					if w.someone_aggroed():
-						time.sleep(0.2)
+						animation.frame(0.2)
 						g.do_full_ui_update()
 		else:
 			show_message("No effect.")
@@ -1052,6 +1589,105 @@ for index in (1, 3, 5, 7):
 	chest_patterns.append([not i for i in pattern])
 direction_mapping = {keymap['move_up']: (0, -1), keymap['move_left']: (-1, 0), keymap['move_down']: (0, 1), keymap['move_right']: (1, 0)}
 
+class OccupancyIndex:
+	# Keeps track of which objects (e.g., monsters) are at each cell, for finding them without a scan.
+	# An indexed object has to be moved with move(), so that the index stays in step with its xy.
+	def __init__(self):
+		self.spots = {}
+		# If set, called as on_change(xy) whenever an object arrives at or leaves a cell.
+		self.on_change = None
+
+	def add(self, obj):
+		self.spots.setdefault(obj.xy, []).append(obj)
+		if self.on_change is not None:
+			self.on_change(obj.xy)
+
+	def remove(self, obj):
+		if self.on_change is not None:
+			self.on_change(obj.xy)
+		here = self.spots[obj.xy]
+		here.remove(obj)
+		if not here:
+			del self.spots[obj.xy]
+
+	def move(self, obj, xy):
+		self.remove(obj)
+		obj.xy = xy
+		self.add(obj)
+
+	def at(self, xy):
+		return self.spots.get(xy, ())
+
+class MonsterScheduler:
+	# Keeps track of which monsters need a turn each time step.
+	# A monster that is neither aggroed nor stunned does nothing on its turn but look for the player,
+	# so it is put to sleep until the player steps into its visible set. While asleep it is filed under
+	# each cell of that set, so waking the monsters that can see a cell is a single lookup.
+	# The awake monsters are kept in the order they were added, so they take their turns in the same order as ever.
+	def __init__(self):
+		self.awake = []
+		self.sleepers = {}
+		# The region each sleeping monster is filed under, and the order the monsters were added in.
+		self.regions = {}
+		self.order = {}
+		self.count = 0
+
+	def add(self, monster):
+		self.order[monster] = self.count
+		self.count += 1
+		self.awake.append(monster)
+
+	def sleep(self, monster, region):
+		self.regions[monster] = region
+		for xy in region:
+			self.sleepers.setdefault(xy, set()).add(monster)
+
+	def unfile(self, monster):
+		# Take a monster out from under its region. Returns whether it was asleep.
+		region = self.regions.pop(monster, None)
+		if region is None:
+			return False
+		for xy in region:
+			here = self.sleepers[xy]
+			here.discard(monster)
+			if not here:
+				del self.sleepers[xy]
+		return True
+
+	def wake(self, monster):
+		self.wake_monsters([monster])
+
+	def wake_monsters(self, monsters):
+		# Wake the ones that are asleep, putting them back in order with a single sort however many there are.
+		woken = [monster for monster in monsters if self.unfile(monster)]
+		if woken:
+			self.awake.extend(woken)
+			self.awake.sort(key=self.order.__getitem__)
+
+	def wake_at(self, xy):
+		# Wake every monster whose region includes xy.
+		self.wake_monsters(list(self.sleepers.get(xy, ())))
+
+	def wake_all(self):
+		self.wake_monsters(self.regions.keys())
+
+	def settle(self, visible_set):
+		# Put the awake monsters with nothing to do to sleep, filed under what they can see from where they are.
+		idle = [monster for monster in self.awake if not monster.aggro and not monster.stun]
+		if idle:
+			self.awake = [monster for monster in self.awake if monster.aggro or monster.stun]
+			for monster in idle:
+				self.sleep(monster, visible_set(monster.xy))
+
+	def discard(self, monsters):
+		# Forget about the given (e.g., dead) monsters.
+		for monster in monsters:
+			self.unfile(monster)
+			del self.order[monster]
+		if monsters:
+			gone = set(monsters)
+			self.awake = [monster for monster in self.awake if monster not in gone]
+
 class World:
 	GAP_PROPORTION    = 0.07
 	HOLE_PROPORTION   = 0.01
@@ -1095,6 +1731,16 @@ class World:
 	# A chest won't have more than this many items in it. (gold isn't an item)
 	MAX_CHEST_CONTENTS     = 2
 
+	# At most this many visible sets are kept memoized.
+	VISIBLE_MEMO_SIZE = 4096
+	# How visible_set is computed: "raycast" for the original flood fill that checks a line of sight to every cell,
+	# or "shadowcast" for the symmetric shadowcasting in fov.py. (Opt in with --shadowcast.) Shadowcasting is much
+	# faster, but sees a little more, and differently: the same seed builds a different world with it.
+	FOV_ENGINE = "raycast"
+	# How the whole-map passes of world generation are run: "numpy" for the versions in npgen.py, or "python".
+	# Both give the same worlds for a given seed.
+	GEN_ENGINE = "numpy" if npgen else "python"
+
 	# Debugging rendering features.
 	print_steps = False
 	print_paths = False
@@ -1103,9 +1749,20 @@ class World:
 		self.coarse_w, self.coarse_h = coarse_w, coarse_h
 		self.w, self.h = 2*self.coarse_w+1, 2*self.coarse_h+1
 		self.camera_track = (1, 1)
+		self.player_source_pathing_map = None
+		self.dirty = CellSet(self.w, self.h)
 		self.visible_count = {}
 		self.monsters = []
 		self.dynamic_objects = []
+		# Where the monsters and dynamic objects are, for finding them by cell.
+		# Their cells get redrawn whenever they come or go.
+		self.monster_index = OccupancyIndex()
+		self.dynamic_index = OccupancyIndex()
+		self.monster_index.on_change = self.dynamic_index.on_change = self.dirty_cell
+		# Which monsters get a turn.
+		self.monster_scheduler = MonsterScheduler()
+		# The lines of sight walked by ray_is_clear on this world's map. (Made on first use.)
+		self.rays = None
 
 	loading_ctr = 0
 	def draw_loading_screen(self):
@@ -1116,10 +1773,13 @@ class World:
 		self.loading_ctr += 1
 		stdscr.refresh()
 
-	def build_world(self):
+	def build_world(self, adam_style=None):
+		# adam_style picks the maze generator, defaulting to the --adam-style flag.
+		if adam_style is None:
+			adam_style = "--adam-style" in sys.argv
 		# XXX: DEBUG, GET RID OF LATER
 		self.steps_doors_dont_count, self.steps = {}, {}
-		self.visible_memo = {}
+		self.visible_memo = VisibilityCache(self.VISIBLE_MEMO_SIZE)
 		# Initialize the player.
 		self.player = Player()
 		counter = [0]
@@ -1138,22 +1798,22 @@ class World:
 				stdscr.addstr(y, 0, " "*(screen_width-1))
 			stdscr.refresh()
 		# Generate the initial maze via a random depth first search.
-#P#		print "Generating maze."
+		profiler.phase("build_world: maze")
 		def gen_grid_snp_style():
 			for x in xrange(1, self.w-1):
 				for y in xrange(1, self.h-1):
-					self.cells[x, y] = Tile(Tile.WALL)
+					self.cells.reset((x, y), Tile.WALL)
 			#self.start_loc = self.random_center()
 			stack = [(None, self.start_loc)]
 			while stack:
 				prev, loc = stack.pop()
-				if self.cells[loc].basic == Tile.BLANK:
+				if self.cells.basic_at(loc) == Tile.BLANK:
 					continue
 				if prev is not None:
-					self.cells[(prev[0]+loc[0])/2, (prev[1]+loc[1])/2] = Tile(Tile.BLANK)
-				self.cells[loc] = Tile(Tile.BLANK)
+					self.cells.reset(((prev[0]+loc[0])/2, (prev[1]+loc[1])/2), Tile.BLANK)
+				self.cells.reset(loc, Tile.BLANK)
 				neighbors = self.get_neighbors(loc)
-				neighbors = [n for n in neighbors if self.cells[n].basic == Tile.WALL and self.cells[n[0]*2-loc[0], n[1]*2-loc[1]].basic == Tile.WALL]
+				neighbors = [n for n in neighbors if self.cells.basic_at(n) == Tile.WALL and self.cells.basic_at((n[0]*2-loc[0], n[1]*2-loc[1])) == Tile.WALL]
 				random.shuffle(neighbors)
 				for n in neighbors:
 					stack.append((loc, (n[0]*2-loc[0], n[1]*2-loc[1])))
@@ -1161,22 +1821,22 @@ class World:
 			update()
 			# At this point the maze is a tree.
 			# Add some random gaps.
-	#P#		print "Placing cracks and rooms."
+			profiler.phase("build_world: rooms")
 			for prop, func in ((self.GAP_PROPORTION, self.random_wall), (self.HOLE_PROPORTION, self.random_tile)):
 				for i in xrange(int(prop * self.coarse_w * self.coarse_h)):
 					xy = func()
 					# Make sure the wall isn't fully surrouneded, or we would (trivially) disconnect the graph!
 					# This is important!
-					if any(self.cells[n].basic == Tile.BLANK for n in self.get_neighbors(xy)):
-						self.cells[xy] = Tile(Tile.BLANK)
+					if any(self.cells.basic_at(n) == Tile.BLANK for n in self.get_neighbors(xy)):
+						self.cells.reset(xy, Tile.BLANK)
 			update()
 			# Add some rooms.
 			for i in xrange(int(self.ROOM_PROPORTION * self.coarse_w * self.coarse_h)):
 				room_w, room_h = random.choice(self.ROOM_SIZES), random.choice(self.ROOM_SIZES)
 				xy = random.choice(range(1, self.w-room_w, 2)), random.choice(range(1, self.h-room_h, 2))
-				for x in xrange(room_w):
-					for y in xrange(room_h):
-						self.cells[xy[0]+x, xy[1]+y] = Tile(Tile.ROOM)
+				room = [(xy[0]+x, xy[1]+y) for x in xrange(room_w) for y in xrange(room_h)]
+				for loc in room:
+					self.cells.reset(loc, Tile.ROOM)
 				update()
 				# Find all the borders to the room.
 				borders = []
@@ -1184,23 +1844,25 @@ class World:
 					x += xy[0]
 					for y in xrange(-1, room_h+1):
 						y += xy[1]
-						if self.cells[x, y].basic == Tile.BLANK:
+						if self.cells.basic_at((x, y)) == Tile.BLANK:
 							borders.append((x, y))
 						# Upgrade walls around rooms to edges, for that dramatic effect.
-						if self.cells[x, y].basic == Tile.WALL:
-							self.cells[x, y].basic = self.ROOMS_MADE_OF
+						if self.cells.basic_at((x, y)) == Tile.WALL:
+							self.cells.set_basic((x, y), self.ROOMS_MADE_OF)
 				# Randomly close off borders, so long as we maintain connectedness.
+				graph = self.build_border_graph(room, borders)
 				while True:
 					random.shuffle(borders)
 					for border in borders[:]:
 						# See if this modification makes the graph disconnected.
-						self.cells[border] = Tile(self.ROOMS_MADE_OF)
-						if not self.is_connected():
-							# Disallowed, undo.
-							self.cells[border] = Tile(Tile.BLANK)
+						if not graph_connected_without(graph, border):
+							# Disallowed.
 							update()
 							continue
 						# Good, this one is allowed.
+						self.cells.reset(border, self.ROOMS_MADE_OF)
+						for n in graph.pop(border):
+							graph[n].discard(border)
 						borders.remove(border)
 						break
 					else: break
@@ -1212,7 +1874,7 @@ class World:
 
 			for x in xrange(1, self.w-1):
 				for y in xrange(1, self.h-1):
-					self.cells[x, y] = Tile(Tile.BLANK)
+					self.cells.reset((x, y), Tile.BLANK)
 				
 
 			def gen_subgrid(xmin, ymin, xmax, ymax):
@@ -1227,16 +1889,16 @@ class World:
 					# Base case: Fill with blank tiles.
 					for x in xrange(xmin,xmax):
 						for y in xrange(ymin,ymax):
-							self.cells[x,y] = Tile(Tile.BLANK)
+							self.cells.reset((x,y), Tile.BLANK)
 				else:
 					# Pick a random point that we can shoot walls from.
 					pivotx = random.randrange(xmin + 1, xmax - 1) # make sure we're not up against an edge (note that the second argument to randrange is exclusive)
 					pivoty = random.randrange(ymin + 1, ymax - 1) # ditto
 					# Project out walls from that point.
 					for x in xrange(xmin,xmax):
-						self.cells[x,pivoty] = Tile(Tile.WALL)
+						self.cells.reset((x,pivoty), Tile.WALL)
 					for y in xrange(ymin,ymax):
-						self.cells[pivotx,y] = Tile(Tile.WALL)
+						self.cells.reset((pivotx,y), Tile.WALL)
 					update()
 					# Generate the subgrids
 					for new_xmin,new_xmax in [(xmin,pivotx),(pivotx+1,xmax)]:
@@ -1250,11 +1912,11 @@ class World:
 						if (xmin == xmax):
 							y = random.randrange(ymin,ymax)
 							for x in xrange(xmin-1,xmin+2):
-								self.cells[x,y] = Tile(Tile.BLANK)
+								self.cells.reset((x,y), Tile.BLANK)
 						elif (ymin == ymax):
 							x = random.randrange(xmin,xmax)
 							for y in xrange(ymin-1,ymin+2):
-								self.cells[x,y] = Tile(Tile.BLANK)
+								self.cells.reset((x,y), Tile.BLANK)
 						else:
 							raise "Wall is neither horizontal nor vertical?! (xmin,xmax,ymin,ymax) = (%d,%d,%d,%d)" % (xmin,xmax,ymin,ymax)
 					all_four_walls = [(pivotx,ymin,pivotx,pivoty),(pivotx,pivoty+1,pivotx,ymax),(xmin,pivoty,pivotx,pivoty),(pivotx+1,pivoty,xmax,pivoty)]	
@@ -1268,7 +1930,8 @@ class World:
 			#print>>f,"Exiting gen_grid"
 			# End of gen_grid_adam_style
 
-		self.cells = {}
+		self.cells = Grid(self.w, self.h)
+		self.cells.on_change = self.tile_changed
 
 		# Place the outermost border of Tile.EDGE tiles.
 		edge_locs = []
@@ -1279,12 +1942,12 @@ class World:
 			edge_locs.append((0, y))
 			edge_locs.append((self.w-1, y))
 		for xy in edge_locs:
-			self.cells[xy] = Tile(Tile.EDGE)
+			self.cells.reset(xy, Tile.EDGE)
 
 		self.start_loc = (1, 1)
 		self.player.xy = self.start_loc
 
-		if "--adam-style" in sys.argv:
+		if adam_style:
 			gen_grid_adam_style()
 		else:
 			gen_grid_snp_style()
@@ -1292,40 +1955,38 @@ class World:
 		self.assert_connected()
 		# Now we start adding objects in other than blanks, walls, and edges.
 		# Add some random unlockable doors.
-#P#		print "Placing doors."
+		profiler.phase("build_world: doors")
 		self.doors = []
 		for i in xrange(int(self.DOOR_PROPORTION * self.coarse_w * self.coarse_h)):
 			xy = self.random_wall()
 			# Make sure the spot makes sense for a door.
 			neighbors = self.get_neighbors(xy)
-			occupancy = [self.cells[n].basic == Tile.WALL for n in neighbors]
+			occupancy = [self.cells.basic_at(n) == Tile.WALL for n in neighbors]
 			if occupancy in ([True, True, False, False], [False, False, True, True]):
-				door = self.cells[xy] = Tile(Tile.DOOR)
+				self.cells.reset(xy, Tile.DOOR)
 				# Store the coordinates of the two sides of the door, while it's easy.
-				door.sides = [n for n in neighbors if self.cells[n].basic != Tile.WALL]
-				self.doors.append(door)
+				sides = [n for n in neighbors if self.cells.basic_at(n) != Tile.WALL]
+				self.doors.append((xy, sides))
 				update()
 		# Cut corners, to make minirooms.
 		# Also, place treasure chests in corners.
-#P#		print "Trimming walls, placing chests."
+		profiler.phase("build_world: trim")
+		basic, width = self.cells.basic, self.w
 		for pattern_set, factory, arg, probability in self.TRIM_OPERATIONS:
 			to_change = []
-			for x in xrange(1, self.w-1):
-				for y in xrange(1, self.h-1):
-					# Determine the neighbor pattern.
-					neighbors = self.get_von_neumann_neighbors((x, y))
-					occupancy = [self.cells[n].is_passable(doors_count=False) for n in neighbors]
-					if occupancy in pattern_set and (self.cells[x, y].basic != Tile.EDGE or self.CORNER_CUT_ROOMS) and \
-					 (factory == Tile or len(self.cells[x,y].contents) == 0): # For now, one thing per cell. (e.g., no overlapping chests and bloodstones)
-						to_change.append((x, y))
+			for x, y in self.match_patterns(pattern_set):
+				i = y*width + x
+				if (basic[i] != Tile.EDGE or self.CORNER_CUT_ROOMS) and \
+				 (factory == Tile or i not in self.cells.contents): # For now, one thing per cell. (e.g., no overlapping chests and bloodstones)
+					to_change.append((x, y))
 			for xy in to_change:
 				if random.random() > probability: continue
 				if factory == Tile:
-					self.cells[xy] = factory(arg)
+					self.cells.reset(xy, arg)
 				else: # It's a Thing
-					self.cells[xy].contents.append(factory(*arg))
+					self.cells.add_thing(xy, factory(*arg))
 				update()
-#P#		print "Placing special elements."
+		profiler.phase("build_world: glass")
 		# Place some glass walls.
 		for i in xrange(int(self.GLASS_PROPORTION * self.coarse_w * self.coarse_h)):
 			loc = self.random_wall()
@@ -1334,10 +1995,10 @@ class World:
 			while stack and len(already_hit) < self.GLASS_WALL_LENGTH:
 				xy = stack.pop()
 				# Only convert walls into glass.
-				if self.cells[xy].basic != Tile.WALL: continue
+				if self.cells.basic_at(xy) != Tile.WALL: continue
 				if xy in already_hit: continue
 				already_hit.add(xy)
-				self.cells[xy].basic = Tile.GLASS
+				self.cells.set_basic(xy, Tile.GLASS)
 				for n in self.get_neighbors(xy):
 					stack.append(n)
 				update()
@@ -1346,35 +2007,25 @@ class World:
 		# The doors not counting map will tell us the value of each door.
 		# However, we still use the door counting map for most other purposes.
 		# Because realistically the player can take a lot of doors.
-		results = [{}, {}]
-		for doors_count in (False, True):
-			steps = results[doors_count]
-			queue = Queue.Queue()
-			queue.put((self.start_loc, 0))
-			while not queue.empty():
-				loc, count = queue.get()
-				if loc in steps:
-					continue
-				steps[loc] = count
-				neighbors = self.get_neighbors(loc)
-				neighbors = [n for n in neighbors if self.cells[n].is_passable(doors_count=doors_count)]
-				for n in neighbors:
-					queue.put((n, count+1))
-		# Name the results we computed.
-		self.steps_doors_dont_count, self.steps = results
+		profiler.phase("build_world: steps")
+		step_counts = npgen.step_counts if self.GEN_ENGINE == "numpy" else pathing.step_counts
+		self.steps_doors_dont_count, self.steps = [step_counts(self.cells, Tile.PASSABLE[doors_count], self.start_loc) for doors_count in (False, True)]
 		# Make the destination be the furthest away point, not using doors.
 		# If you instead count doors then the destination selection tends to make doors useless.
 		self.dest_loc = max(self.steps_doors_dont_count.keys(), key=self.steps_doors_dont_count.get)
-		self.cells[self.dest_loc] = Tile(Tile.DESTINATION)
-		self.cells[self.start_loc] = Tile(Tile.START)
+		self.cells.reset(self.dest_loc, Tile.DESTINATION)
+		self.cells.reset(self.start_loc, Tile.START)
 		# Compute the value of each door, in terms of how many steps it saves.
-		for door in self.doors:
+		for xy, sides in self.doors:
+			# Doors can get trimmed away after being placed.
+			if self.cells.basic_at(xy) != Tile.DOOR: continue
+			door = self.cells[xy]
 			# If one side of the door isn't in steps_doors_dont_count,
 			# then it means that the door passes into a special only doors allowed section.
 			# This is quite rare! Mark the door as a magical barrier.
 			flag = 0
-			for xy in door.sides:
-				if xy not in self.steps_doors_dont_count:
+			for side in sides:
+				if side not in self.steps_doors_dont_count:
 					door.basic = Tile.MAGIC_BARRIER
 					flag += 1
 			if flag == 2:
@@ -1382,7 +2033,7 @@ class World:
 				# We blank them out, so magical areas are a little sparser
 				door.basic = Tile.BLANK
 			if flag: continue
-			side_values = [self.steps_doors_dont_count[xy] for xy in door.sides]
+			side_values = [self.steps_doors_dont_count[side] for side in sides]
 			door.steps_skipped = max(side_values) - min(side_values)
 			# Delete the door if it's too useless.
 			if door.steps_skipped < self.DOOR_THRESHOLD:
@@ -1393,8 +2044,8 @@ class World:
 		for obj, prob in [(Chest, self.GOLD_PROPORTION)]:
 			for i in xrange(int(prob * self.coarse_w * self.coarse_h)):
 				xy = self.random_tile()
-				if self.cells[xy].basic == Tile.BLANK:
-					self.cells[xy].contents.append(obj())
+				if self.cells.basic_at(xy) == Tile.BLANK:
+					self.cells.add_thing(xy, obj())
 					update()
 		# Add enemies, based on a simple algorithm:
 		# Compute the number of tiles visible from each open tile. Place an enemy at the
@@ -1405,12 +2056,19 @@ class World:
 		# of the enemy is scaled by the number of visible tiles. For example, high difficulty
 		# low tile count spawns traps, while high tile count spawns boss enemies, because
 		# it's likely to be in the middle of a room.
-#P#		print "Finding visibility map."
+		profiler.phase("build_world: visibility")
+		# Every count is worked out up front. Counting a tile only once it reached the top of the heap below would need
+		# a cheap upper bound on its count to file it under until then, and there isn't a useful one: the maze is one
+		# open region, so short of tracing the field of view, a tile could see most of the map. With a bound that loose,
+		# every tile would reach the top, and get counted, before any counted tile could be picked.
+		passable = Tile.PASSABLE[False]
 		for x in xrange(self.w):
 			for y in xrange(self.h):
 				# Only consider passible squares.
-				if self.cells[x, y].is_passable(doors_count=False):
-					self.visible_count[x, y] = len(self.visible_set((x, y)))
+				# Just the sizes are needed here, so the sets aren't memoized. Only the few that get used
+				# to disqualify tiles below are, rather than all of them churning through the memo.
+				if passable[basic[y*width+x]]:
+					self.visible_count[x, y] = len(self.compute_visible_set((x, y)))
 				rare_update(30)
 		# Disqualify tiles adjacent to the origin.
 		def disqualify_from(spot):
@@ -1418,11 +2076,18 @@ class World:
 				if xy in self.visible_count:
 					self.visible_count.pop(xy)
 		disqualify_from(self.start_loc)
-#P#		print "Populating monsters."
+		profiler.phase("build_world: monsters")
+		# Keep the candidates in a heap, most visible first. Ties go to whichever comes first in visible_count,
+		# just like with max() over it. (Removing keys from a dict doesn't reorder the rest, so this stays true.)
+		# Disqualified tiles aren't taken out of the heap, just skipped over when they reach the top.
+		heap = [(-count, rank, xy) for rank, (xy, count) in enumerate(self.visible_count.iteritems())]
+		heapq.heapify(heap)
 		while self.visible_count:
 			# Now, find the most visible tile.
-			spot = max(self.visible_count, key=self.visible_count.get)
-			visible_tiles = self.visible_count[spot]
+			visible_tiles, rank, spot = heapq.heappop(heap)
+			if spot not in self.visible_count:
+				continue
+			visible_tiles = -visible_tiles
 			# Only spawn the enemy with a probability that goes up with the number of visible tiles.
 			probability = 1.0 - (1.0 - self.ENEMY_PROBABILITY) * math.e**(-visible_tiles/float(self.ENEMY_TILE_CONSTANT))
 			if random.random() <= probability:
@@ -1432,7 +2097,7 @@ class World:
 			disqualify_from(spot)
 			update()
 		# Place extremely rare stuff, like nether cracks.
-#P#		print "Placing rare objects and world elements."
+		profiler.phase("build_world: rare objects and loot")
 		# Spawn a nether crack: A cell on the border that is a Tile.WALL tile.
 		# If the user uses any of the available means of breaking down walls, this
 		# will result in a gap off the map, allowing the user to enter the nether.
@@ -1444,10 +2109,11 @@ class World:
 					magical_edges.append(xy)
 		# Place the nether crack.
 		if magical_edges and random.random() <= self.NETHER_CRACK_PROBABILITY:
-			self.cells[random.choice(magical_edges)] = Tile(Tile.WALL)
+			self.cells.reset(random.choice(magical_edges), Tile.WALL)
 		# Populate the treasure chests with items.
-		for xy, tile in self.cells.iteritems():
-			for thing in tile.contents:
+		for index, contents in self.cells.contents.iteritems():
+			xy = self.cells.xy_of(index)
+			for thing in contents:
 				if isinstance(thing,Chest):
 					# Compute the treasure chest value.
 					value_rating = self.steps_doors_dont_count.get(xy, 100)/4
@@ -1455,19 +2121,20 @@ class World:
 		# Finally, one last connectedness assertion.
 		self.assert_connected()
 		# Initialize the fog.
-		self.revealed = set()
+		self.revealed = CellSet(self.w, self.h)
 		# Compute the shortest path, just for debugging sake.
-#P#		print "Computing pathing."
+		profiler.phase("build_world: paths")
 		self.shortest_winning_path = self.shortest_path(self.player.xy, self.dest_loc)
 		self.shortest_doorless_path = self.shortest_path(self.player.xy, self.dest_loc, doors_count=False)
 		# For efficiency rerendering, use a dirty list.
 		# Initally, everything is dirty, to require a full first rerender.
 		self.full_rerender()
 		clear_entire_screen()
+		profiler.phase(None)
 
 
 	def generate_empty_grid(self):
-		cells = {}
+		cells = Grid(self.w, self.h)
 		edge_locs = []
 		for x in xrange(self.w):
 			edge_locs.append((x, 0))
@@ -1476,19 +2143,21 @@ class World:
 			edge_locs.append((0, y))
 			edge_locs.append((self.w-1, y))
 		for xy in edge_locs:
-			cells[xy] = Tile(Tile.EDGE)
+			cells.reset(xy, Tile.EDGE)
 		for x in xrange(1,self.w-1):
 			for y in xrange(1,self.h-1):
-				cells[x,y] = Tile(Tile.BLANK)
+				cells.reset((x,y), Tile.BLANK)
 		return cells
 
 	def build_world_abridged(self):
 		# Quickly builds a not terribly exciting world for testing purposes
-		self.steps_doors_dont_count, self.steps, self.visible_memo = {}, {}, {}
-		self.revealed = set()
+		self.steps_doors_dont_count, self.steps = {}, {}
+		self.visible_memo = VisibilityCache(self.VISIBLE_MEMO_SIZE)
+		self.revealed = CellSet(self.w, self.h)
 		self.player = Player()
 		# Generate grid
 		self.cells = self.generate_empty_grid()
+		self.cells.on_change = self.tile_changed
 
 		pattern = [
 		"## #####",
@@ -1503,15 +2172,15 @@ class World:
 		for x in xrange(1,self.w-1):
 			for y in xrange(1,self.h-1):
 				if pattern[y%8][x%8] == " ":
-					self.cells[x,y] = Tile(Tile.BLANK)
+					self.cells.reset((x,y), Tile.BLANK)
 				else:
-					self.cells[x,y] = Tile(Tile.WALL)
+					self.cells.reset((x,y), Tile.WALL)
 				if x%8 == 1 and y%8 == 5:
 					self.cells[x,y].contents = [Chest()]
 					self.cells[x,y].contents[0].populate_gold(10*(x+y))
-		self.cells[9,1].contents.append(Bloodstone())
-		self.cells[1,1] = Tile(Tile.START)
-		self.cells[self.w-2,self.h-2] = Tile(Tile.DESTINATION)
+		self.cells.add_thing((9,1), Bloodstone())
+		self.cells.reset((1,1), Tile.START)
+		self.cells.reset((self.w-2,self.h-2), Tile.DESTINATION)
 		self.start_loc = (1,1)
 		self.player.xy = self.start_loc
 		self.dest_loc = (self.w-2,self.h-2)
@@ -1523,7 +2192,7 @@ class World:
 		for x in xrange(self.w):
 			for y in xrange(self.h):
 				# Only consider passible squares.
-				if self.cells[x, y].is_passable(doors_count=False):
+				if self.is_passable((x, y), doors_count=False):
 					self.visible_count[x, y] = len(self.visible_set((x, y)))
 			update()
 
@@ -1543,20 +2212,36 @@ class World:
 		# In an ideal world, it would be checked every single instant,
 		# but that is inefficient, so we just check occasionally.
 		self.check_state_based_effects()
-		# Build a pathing map for the monsters to use.
-		self.player_source_pathing_map = self.build_pathing_map(w.player.xy, [m.xy for m in self.monsters], doors_count=False)
+		# Update the pathing map for the monsters to use.
+		self.update_player_pathing()
 		# Let the player update.
 		self.player.do_ai()
-		# In each game time step let each monster do a time step.
-		for monster in self.monsters:
+		# In each game time step let each awake monster do a time step.
+		# (Sleeping monsters that could see the player from where they are wake up first.)
+		self.monster_scheduler.wake_at(self.player.xy)
+		for monster in self.monster_scheduler.awake:
 			monster.do_ai()
 		# Then, update all the dynamic objects. (projectiles, etc.)
 		for dynamic in self.dynamic_objects:
 			dynamic.time_step()
 		# Next, have a combat round.
-		for monster in self.monsters:
+		for monster in self.monster_scheduler.awake:
 			monster.do_combat()
 		self.check_state_based_effects()
+		# Monsters with nothing to do go to sleep until the player comes into view.
+		self.monster_scheduler.settle(self.visible_set)
+
+	def update_player_pathing(self):
+		# Monsters walk towards the player along a distance field rooted at the player.
+		# The field is kept across turns while the player stays put (tile_changed drops it if the terrain changes),
+		# and it only ever gets searched as far out as the aggroed monsters that consult it.
+		# A move starts a fresh field rather than patching the old one. A step moves every distance by one, and a repair
+		# (shift them all up by one, then lower the ones the player stepped towards) still has to visit every cell
+		# on the far side of the player: about 390 cells per move walking the winning path of a 35x25 world, where
+		# the fresh field only gets searched out to the aggroed monsters, about 20 cells.
+		field = self.player_source_pathing_map
+		if field is None or field.source != self.player.xy:
+			self.player_source_pathing_map = pathing.DistanceField(self.cells, Tile.PASSABLE[False], self.player.xy)
 
 	def check_state_based_effects(self):
 		# If the player has lost, alert him or her.
@@ -1567,26 +2252,68 @@ class World:
 			self.player.hp = self.player.max_hp
 			#exit()
 		# Eliminate the dead monsters.
-		for monster in self.monsters[:]:
-			if monster.should_die():
-				self.monsters.remove(monster)
-				# Grant the player XP for the monster.
-				self.player.xp += monster.xp_granted
+		dead_monsters = self.cull(self.monsters, self.monster_index)
+		self.monster_scheduler.discard(dead_monsters)
+		# Grant the player XP for the monsters.
+		self.player.xp += sum(monster.xp_granted for monster in dead_monsters)
 		# Make the player level up, if appropriate.
 		self.player.check_for_level_up()
 		# Eliminate the dead dynamic objects.
-		for dynamic in self.dynamic_objects[:]:
-			if dynamic.should_die():
-				self.dynamic_objects.remove(dynamic)
+		dead_dynamic_objects = self.cull(self.dynamic_objects, self.dynamic_index)
+		return dead_monsters, dead_dynamic_objects
+
+	def cull(self, entities, index):
+		# Remove every entity that should die from the list (and the index) in a single pass,
+		# keeping the survivors in order. Returns the removed entities.
+		survivors, dead = [], []
+		for entity in entities:
+			(dead if entity.should_die() else survivors).append(entity)
+		if dead:
+			entities[:] = survivors
+			for entity in dead:
+				index.remove(entity)
+		return dead
+
+	def add_monster(self, monster):
+		self.monsters.append(monster)
+		self.monster_index.add(monster)
+		self.monster_scheduler.add(monster)
+
+	def add_dynamic_object(self, dynamic):
+		self.dynamic_objects.append(dynamic)
+		self.dynamic_index.add(dynamic)
+
+	def state_digest(self):
+		# A hash of the game state, for checking that two runs ended up in the same place.
+		h = hashlib.sha1()
+		def add(*values):
+			h.update(repr(values))
+		add(self.w, self.h, str(self.cells.basic))
+		for index in sorted(self.cells.contents):
+			for thing in self.cells.contents[index]:
+				add(index, thing.__class__.__name__, getattr(thing, "gold_content", None),
+					sorted((itemtype.name, count) for itemtype, count in getattr(thing, "inventory", {}).iteritems()))
+		p = self.player
+		add(p.xy, p.hp, p.mp, p.xp, p.level, p.gold, sorted((itemtype.name, count) for itemtype, count in p.inventory.iteritems()))
+		for m in self.monsters:
+			add(m.__class__.__name__, m.xy, m.hp, m.aggro, m.stun)
+		for dynamic in self.dynamic_objects:
+			add(dynamic.__class__.__name__, dynamic.xy)
+		add(sorted(self.revealed))
+		return h.hexdigest()
 
 	def someone_aggroed(self):
-		return any(m.aggro for m in self.monsters)
+		# Sleeping monsters are never aggroed.
+		return any(m.aggro for m in self.monster_scheduler.awake)
 
 	def full_rerender(self):
-		self.dirty = set((x, y) for x in xrange(self.w) for y in xrange(self.h))
+		# Every cell, from index 0 up.
+		self.dirty = CellSet(self.w, self.h)
+		self.dirty.bits = (1 << (self.w*self.h)) - 1
 
 	def is_connected(self):
 		# Do a simple DFS to see if the world is connected.
+		basic, passable, width = self.cells.basic, Tile.PASSABLE[True], self.w
 		self.reached = set()
 		stack = [self.start_loc]
 		while stack:
@@ -1594,20 +2321,111 @@ class World:
 			if xy in self.reached: continue
 			self.reached.add(xy)
 			for n in self.get_neighbors(xy):
-				if self.cells[n].is_passable():
+				if passable[basic[n[1]*width+n[0]]]:
 					stack.append(n)
 		# Check if every passable cell has been touched.
-		for xy, tile in self.cells.iteritems():
-			if tile.is_passable() and xy not in self.reached:
+		for i, b in enumerate(basic):
+			if passable[b] and self.cells.xy_of(i) not in self.reached:
 				return False
 		return True
 
+	def match_patterns(self, pattern_set):
+		# Find the interior cells whose neighbor pattern (see TRIM_OPERATIONS) is in pattern_set, x-major.
+		if self.GEN_ENGINE == "numpy":
+			return npgen.match_patterns(self.cells, Tile.PASSABLE[False], pattern_set)
+		basic, passable, width = self.cells.basic, Tile.PASSABLE[False], self.w
+		matches = []
+		for x in xrange(1, self.w-1):
+			for y in xrange(1, self.h-1):
+				# Determine the neighbor pattern.
+				i = y*width + x
+				occupancy = [passable[basic[i+dx+dy*width]] for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+				if occupancy in pattern_set:
+					matches.append((x, y))
+		return matches
+
+	def build_border_graph(self, room, borders):
+		# Summarize the connectivity of the map around a freshly placed room, for deciding which borders can be closed.
+		# The room, and each region of passable cells outside it (not counting the borders), become single nodes
+		# numbered from 0 for the room, while each border stays a node of its own, keyed by its xy.
+		# Every path into the room crosses its ring of borders, so the map is connected exactly when this graph is.
+		# Closing a border just removes its node, so each check only costs the size of the room's perimeter.
+		basic, passable, width = self.cells.basic, Tile.PASSABLE[True], self.w
+		offsets = (-1, 1, -width, width)
+		border_set = set(borders)
+		room_cells = set(loc[1]*width+loc[0] for loc in room)
+		blocked = room_cells | set(x+y*width for x, y in borders)
+		# Only the outside cells touching the ring matter, and the map was connected before the room went in,
+		# so every region contains some of them. Grow a search from each of them at once, merging searches as they meet.
+		# Once at most one search can still grow, no more merges can happen: a search that ran out of cells has found
+		# its whole region. Usually everything merges close to the room, so this doesn't have to visit the whole map.
+		owner, parent, fronts = {}, {}, {}
+		for j in sorted(blocked):
+			for d in offsets:
+				n = j+d
+				if n not in blocked and n not in owner and passable[basic[n]]:
+					owner[n] = parent[n] = n
+					fronts[n] = [n]
+		def find(a):
+			while parent[a] != a:
+				parent[a] = parent[parent[a]]
+				a = parent[a]
+			return a
+		while len(fronts) > 1:
+			for root in fronts.keys():
+				if root not in fronts:
+					continue
+				grown = []
+				for i in fronts.pop(root):
+					for d in offsets:
+						n = i+d
+						if n in blocked or not passable[basic[n]]:
+							continue
+						other = owner.get(n)
+						if other is None:
+							owner[n] = root
+							grown.append(n)
+						elif other != root:
+							other = find(other)
+							if other != root:
+								parent[other] = root
+								grown.extend(fronts.pop(other, ()))
+				if grown:
+					fronts[root] = grown
+		# Number the regions, with the room as region 0.
+		region = dict.fromkeys(room_cells, 0)
+		graph = {0: set()}
+		for i, seed in owner.iteritems():
+			if i == seed:
+				root = find(i)
+				if root not in graph:
+					graph[root] = set()
+				region[i] = root
+		def connect(a, b):
+			graph[a].add(b)
+			graph[b].add(a)
+		for border in borders:
+			graph[border] = set()
+		for border in borders:
+			for n in self.get_neighbors(border):
+				if n in border_set:
+					connect(border, n)
+				elif n[1]*width+n[0] in region:
+					connect(border, region[n[1]*width+n[0]])
+		# Regions can also touch the room directly. (e.g., through an earlier overlapping room)
+		for loc in room:
+			for n in self.get_neighbors(loc):
+				label = region.get(n[1]*width+n[0])
+				if label:
+					connect(0, label)
+		return graph
+
 	def assert_connected(self):
 		# Guarantee that the graph really is connected.
 		if not self.is_connected():
 			# Mark every reached cell.
 			for xy in self.reached:
-				self.cells[xy].basic = Tile.START
+				self.cells.reset(xy, Tile.START)
 			self.pprint()
 			print red+"NOT CONNECTED"
 			exit()
@@ -1617,73 +2435,74 @@ class World:
 		# The map is expanded until every point in points_to_include is included.
 		# The idea is that you can build a single pathing map if paths to one point
 		# need to be routed from many other points. (e.g. enemies to the player)
-		parent = {}
-		queue = Queue.Queue()
-		queue.put((None, source))
-		points_to_include = set(points_to_include)
-		while points_to_include and not queue.empty():
-			prev, xy = queue.get()
-			if xy in parent: continue
-			parent[xy] = prev
-			if xy in points_to_include:
-				points_to_include.remove(xy)
-			neighbors = self.get_neighbors(xy)
-			random.shuffle(neighbors)
-			for n in neighbors:
-				if self.cells[n].is_passable(doors_count=doors_count):
-					queue.put((xy, n))
-		return parent
+		return pathing.pathing_map(self.cells, Tile.PASSABLE[bool(doors_count)], source, points_to_include)
 
 	def shortest_path(self, a, b, doors_count=True):
 		parent = self.build_pathing_map(a, [b], doors_count=doors_count)
-#		parent = {}
-#		queue = Queue.Queue()
-#		queue.put((a, a))
-#		while not queue.empty():
-#			prev, xy = queue.get()
-#			if xy in parent: continue
-#			parent[xy] = prev
-#			if xy == b: break
-#			neighbors = self.get_neighbors(xy)
-#			random.shuffle(neighbors)
-#			for n in neighbors:
-#				if self.cells[n].is_passable(doors_count=doors_count):
-#					queue.put((xy, n))
-		# Trace back the path
-		path = [b]
-		while path[-1] is not None:
-			path.append(parent[path[-1]])
-		return path[-2::-1]
+		return pathing.trace_path(parent, b)
 
 	def check_if_unoccupied_by_people(self, xy):
 		# Check if there are monsters and no players in a given cell.
-		if xy == w.player.xy:
-			return False
-		for m in self.monsters:
-			if xy == m.xy:
-				return False
-		return True
+		return xy != self.player.xy and not self.monster_index.at(xy)
+
+	def dirty_cell(self, xy):
+		# Called by the occupancy indexes whenever something drawn over the map comes or goes.
+		self.dirty.add(xy)
+
+	def move_player(self, xy):
+		# Move the player, redrawing the cells they leave and enter.
+		self.dirty.add(self.player.xy)
+		self.player.xy = xy
+		self.dirty.add(xy)
+
+	def tile_changed(self, xy, old, new):
+		# Called by the grid whenever a tile changes type. (e.g., a door being unlocked)
+		self.dirty.add(xy)
+		if Tile.TRANSPARENT[old] != Tile.TRANSPARENT[new]:
+			self.visible_memo.invalidate(xy)
+			# The monsters sleeping with xy in view might now see more (or less), so let them look again.
+			self.monster_scheduler.wake_at(xy)
+		if Tile.PASSABLE[False][old] != Tile.PASSABLE[False][new]:
+			self.player_source_pathing_map = None
+
+	def is_passable(self, xy, doors_count=True):
+		return Tile.PASSABLE[bool(doors_count)][self.cells.basic_at(xy)]
+
+	def is_transparent(self, xy):
+		return Tile.TRANSPARENT[self.cells.basic_at(xy)]
 
 	def check_line_of_sight(self, a, b):
-		if a == b: return True
-		delta = b[0] - a[0], b[1] - a[1]
-		norm = (delta[0]**2.0 + delta[1]**2.0)**0.5
-		unit = delta[0]/norm, delta[1]/norm
-		for c in xrange(0, int(norm)+1):
-			xy = int(a[0] + 0.5 + unit[0] * c), int(a[1] + 0.5 + unit[1] * c)
-			if xy == a or xy == b: continue
-			if not self.cells[xy].is_transparent():
-				return False
-		return True
+		# Whether b is in sight from a. This goes by visible_set, so it agrees with what is drawn as visible.
+		# (With the raycast engine, that means walking the rays in self.rays, once per origin: the sets are memoized.)
+		return b in self.visible_set(a)
+
+	def ray_is_clear(self, a, b):
+		# Whether the straight line from a to b is unobstructed. (The raycast engine builds visible sets out of these.)
+		# The rays are only worked out if they are used, so a world using another engine doesn't keep a table of them.
+		if self.rays is None:
+			self.rays = fov.RayTable(self.w, self.h)
+		return fov.line_of_sight(a, b, self.cells.basic, self.rays, Tile.TRANSPARENT)
 
 	def visible_set(self, origin):
-		if origin in self.visible_memo:
-			return self.visible_memo[origin]
+		# Returns the cells visible from origin, as a CellSet.
+		reached = self.visible_memo.get(origin)
+		if reached is None:
+			reached = self.visible_memo[origin] = CellSet(self.w, self.h, self.compute_visible_set(origin))
+		return reached
+
+	def compute_visible_set(self, origin):
+		# Like visible_set, but always computed afresh, not memoized, and as a plain set of (x, y) tuples.
+		if self.FOV_ENGINE == "shadowcast":
+			return fov.shadowcast(origin, self.cells.basic, self.w, self.h, Tile.TRANSPARENT)
+		return self.raycast_visible_set(origin)
+
+	def raycast_visible_set(self, origin):
+		# Flood out from the origin, keeping every cell with a clear line of sight.
 		stack = [origin]
 		reached = set()
 		while stack:
 			xy = stack.pop()
-			if xy in reached or not self.check_line_of_sight(origin, xy):
+			if xy in reached or not self.ray_is_clear(origin, xy):
 				continue
 			reached.add(xy)
 			for n in self.get_neighbors(xy):
@@ -1691,13 +2510,14 @@ class World:
 				if n not in reached:
 					for nn in self.get_neighbors(n):
 						stack.append(nn)
-		self.visible_memo[origin] = reached
 		return reached
 
 	def see_from(self, origin):
-		for xy in self.visible_set(origin):
-			self.revealed.add(xy)
-			self.dirty.add(xy)
+		# Only newly revealed cells need to be redrawn.
+		new = self.visible_set(origin) - self.revealed
+		if new:
+			self.revealed |= new
+			self.dirty |= new
 
 	def get_neighbors(self, xy):
 		return [(xy[0]+i, xy[1]+j) for i, j in ((-1, 0), (1, 0), (0, -1), (0, 1))]
@@ -1715,8 +2535,12 @@ class World:
 		return (2*random.randrange(1, self.w/2), 2*random.randrange(1, self.h/2))
 
 	def print_character(self, x, y, desc):
+		if headless:
+			# The curses character constants only exist with a real terminal.
+			world_pad.addch(y, x, desc)
+			return
 		color, s = desc
-		special, attr = 0, curses.color_pair(color_mapping[color])
+		special, attr = 0, color_attr(color)
 		if s == "\xff":
 			special |= curses.A_ALTCHARSET
 			s = curses.ACS_CKBOARD
@@ -1733,13 +2557,7 @@ class World:
 
 	def pprint(self, everything=False):
 		# This ordering defines which overlay objects are drawn on top of which.
-		overlay_spots = {}
-		def add(obj):
-			if obj.xy not in overlay_spots:
-				overlay_spots[obj.xy] = []
-			overlay_spots[obj.xy].append(obj)
-		map(add, self.monsters)
-		map(add, self.dynamic_objects)
+		overlay_indexes = (self.monster_index, self.dynamic_index)
 		def composite(a, b):
 			# Compose two characters, with b overlayed on a.
 			a1, a2 = a[:2], a[2:]
@@ -1751,7 +2569,7 @@ class World:
 			tile = self.cells[x, y]
 			s = tile.to_string()
 			# Draw obscuring fog.
-			if (not everything) and (x, y) not in self.revealed:
+			if (x, y) in fogged:
 				return foggy + ":" + foggy + ":"
 			# Render for debugging purposes.
 			if (x, y) in self.visible_count:
@@ -1773,20 +2591,42 @@ class World:
 			for thing in tile.contents:
 				s = composite(s, thing.to_string())
 			# Draw any appropriate monsters, projectiles, or other objects on top.
-			if (x, y) in overlay_spots:
-				for overlay_object in overlay_spots[x, y]:
+			for index in overlay_indexes:
+				for overlay_object in index.at((x, y)):
 					s = composite(s, overlay_object.to_string())
 			if (x, y) == self.player.xy:
 				s = composite(s, player_color + "P" + __)
 			return s
-		for x, y in (self.cells if everything else self.cells):
+		if everything:
+			to_draw = self.cells
+			fogged = ()
+		else:
+			# Only redraw what changed. (The cells things drawn over the map move between are marked dirty as they move.)
+			to_draw = self.dirty
+			# Find the fogged dirty cells all at once, rather than looking each one up in revealed.
+			fogged = set(self.dirty - self.revealed)
+		for x, y in to_draw:
 			s = print_cell(x, y)
 			self.print_character(2*x, y, s[:2])
 			self.print_character(2*x+1, y, s[2:])
-		self.dirty = set()
+		self.dirty = CellSet(self.w, self.h)
 #		stdscr.addstr(y, 0, " ".join(get(x, y) for x in xrange(self.w)))
 
 
+def graph_connected_without(graph, removed):
+	# Check whether a graph (a dict from each node to the set of its neighbors) stays connected without one of its nodes.
+	nodes = [node for node in graph if node != removed]
+	if not nodes:
+		return True
+	reached = set([nodes[0]])
+	stack = [nodes[0]]
+	while stack:
+		for n in graph[stack.pop()]:
+			if n != removed and n not in reached:
+				reached.add(n)
+				stack.append(n)
+	return len(reached) == len(nodes)
+
 def gen_item_listing(inventory):
 	inv = sorted(inventory.items(), key=lambda x: x[0].sort_index)
 	return [" %2i) %s " % (count, itemtype.name) for itemtype, count in inv]
@@ -1803,15 +2643,26 @@ def show_info_pane_message(msg):
 def get_input(prompt):
 	stdscr.addstr(screen_height-1, 0, prompt)
 	# Request a string.
-	curses.echo()
-	curses.curs_set(1)
+	set_cursor_echo(True)
 	string = stdscr.getstr(screen_height-1, len(prompt), 32)
-	curses.noecho()
-	curses.curs_set(0)
+	set_cursor_echo(False)
 	# Clear out the line.
 	stdscr.addstr(screen_height-1, 0, " " * (len(prompt) + 32))
 	return string
 
+def set_cursor_echo(flag):
+	# Turn the cursor and typed character echoing on or off, for text entry.
+	if headless: return
+	if flag:
+		curses.echo()
+	else:
+		curses.noecho()
+	curses.curs_set(int(flag))
+
+def set_cursor_visibility(visibility):
+	if not headless:
+		curses.curs_set(visibility)
+
 def get_input_char(prompt):
 	stdscr.addstr(screen_height-1, 0, prompt)
 	v = stdscr.getch(0, 0)
@@ -1835,7 +2686,7 @@ def get_location_selection(prompt, validator):
 	prompt += " (enter confirms/esc cancels)"
 	try:
 		stdscr.addstr(screen_height-1, 0, prompt)
-		curses.curs_set(2)
+		set_cursor_visibility(2)
 		xy = w.player.xy
 		if not validator(xy):
 			# As a hack, if the validator fails on us to start with,
@@ -1856,7 +2707,7 @@ def get_location_selection(prompt, validator):
 			elif key == 10 or key == 13:
 				return xy
 	finally:
-		curses.curs_set(0)
+		set_cursor_visibility(0)
 		stdscr.addstr(screen_height-1, 0, " " * len(prompt))
 
 class Game:
@@ -1894,7 +2745,7 @@ class Game:
 		# Add the middle.
 		s = "=" * int((width-2) * proportion)
 		s += " " * (width - 2 - len(s))
-		info_pane.addstr(y, 1, s, curses.color_pair(color_mapping[color]))
+		info_pane.addstr(y, 1, s, color_attr(color))
 
 	def add_line(self, s):
 		self.line_index += 1
@@ -1966,11 +2817,7 @@ class Game:
 		self.refresh_screen()
 		self.redraw_info_pane()
 
-	def main_loop(self, _stdscr):
-		global stdscr, world_pad, info_pane, w, screen_height, screen_width
-		stdscr = _stdscr
-		screen_height, screen_width = stdscr.getmaxyx()
-
+	def layout(self):
 		# Do some screen layout work.
 		# Layout:
 		# /-----\/-\
@@ -1993,21 +2840,40 @@ class Game:
 		self.info_pane_size = screen_width - self.map_size[0], screen_height
 		self.textbox_size = self.map_size[0], 1
 
+	def main_loop(self, _stdscr):
+		global stdscr, world_pad, info_pane, w, screen_height, screen_width
+		stdscr = _stdscr
+		screen_height, screen_width = stdscr.getmaxyx()
+		self.layout()
+		if "--shadowcast" in sys.argv:
+			World.FOV_ENGINE = "shadowcast"
+
 #		w = World(20, 15)
 		w = World(35, 25)
 #		w = World(55, 35)
+		# A saved world is loaded up front, so that the pad can be made to fit it.
+		if get_option("--load"):
+			load_world(get_option("--load"))
 
-		# Allocate a pad to store the rendered map.
-		# DEBUG: It seems to want an extra column, for some reason I can't figure out. :(
-		world_pad = curses.newpad(w.h, w.w*2+1)
-		# Allocate a window to draw the info pane.
-		info_pane = curses.newwin(self.info_pane_size[0], self.info_pane_size[1], 0, self.map_size[0])
+		if headless:
+			world_pad = info_pane = stdscr
+		else:
+			# Allocate a pad to store the rendered map.
+			# DEBUG: It seems to want an extra column, for some reason I can't figure out. :(
+			world_pad = curses.newpad(w.h, w.w*2+1)
+			# Allocate a window to draw the info pane.
+			info_pane = curses.newwin(self.info_pane_size[0], self.info_pane_size[1], 0, self.map_size[0])
+			if key_log is not None:
+				world_pad = RecordingScreen(world_pad)
+
+		animation.speed = float(get_option("--animation-speed", 1.0))
 
-		if "--quick" in sys.argv:
-			w = World(15,13)
-			w.build_world_abridged() 
+		if get_option("--load"):
+			pass
+		elif "--quick" in sys.argv:
+			make_world(15, 13, quick=True)
 		else:
-			w.build_world()
+			make_world(35, 25)
 
 
 		equip_slots = {}
@@ -2017,6 +2883,7 @@ class Game:
 		digit_ords = map(ord, map(str, xrange(10)))
 
 		while True:
+			animation.start()
 			# Cast player vision.
 			w.see_from(w.player.xy)
 			# Check for things like victory, and player death.
@@ -2031,8 +2898,8 @@ class Game:
 			if action in direction_mapping:
 				delta = direction_mapping[action]
 				new_xy = w.player.xy[0]+delta[0], w.player.xy[1]+delta[1]
-				if w.cells[new_xy].is_passable(doors_count=False) and w.check_if_unoccupied_by_people(new_xy):
-					w.player.xy = new_xy
+				if w.is_passable(new_xy, doors_count=False) and w.check_if_unoccupied_by_people(new_xy):
+					w.move_player(new_xy)
 					# Only do a time step if we actually move.
 					w.time_step()
 			elif action == keymap['wait']:
@@ -2081,10 +2948,9 @@ class Game:
 				place = get_location_selection("Info about what?", lambda xy: xy in w.revealed)
 				if not place:
 					continue
-				for m in w.monsters:
-					if m.xy == place:
-						show_info_pane_message(m.name + "\n" + m.description)
-						break # For the time being, only handle one monster. (Can monsters even overlap?)
+				for m in w.monster_index.at(place):
+					show_info_pane_message(m.name + "\n" + m.description)
+					break # For the time being, only handle one monster. (Can monsters even overlap?)
 				for o in w.cells[place].contents:
 					show_info_pane_message(o.name + "\n" + o.description)
 			elif action == keymap['free_camera']:
@@ -2129,17 +2995,23 @@ class Game:
 						if key == ord("w"): w.time_step()
 						else: break
 					stdscr.addstr(screen_height-1, 0, " " * len(prompt))
+				elif rare == "save":
+					path = get_input("Save to: ").strip()
+					if path:
+						try:
+							save_world(w, path)
+							show_message("Saved. (Play it again with --load %s)" % path)
+						except (IOError, ValueError) as e:
+							show_message("Could not save: %s" % e)
 				elif rare == "cheat":
 					# Run a cheat
 					cheat = get_input("Cheat: ").strip()
 					if cheat == "show":
 						w.full_rerender()
-						for x in xrange(w.w):
-							for y in xrange(w.h):
-								w.revealed.add((x, y))
+						w.revealed |= w.cells
 					elif cheat == "hide":
 						w.full_rerender()
-						w.revealed = set()
+						w.revealed = CellSet(w.w, w.h)
 					elif cheat == "path":		
 						w.full_rerender()
 						w.print_paths ^= 1
@@ -2147,14 +3019,14 @@ class Game:
 						w.full_rerender()
 						w.print_steps ^= 1
 					elif cheat == "new":
-						w = World(35, 25)
-						w.build_world()
+						make_world(35, 25)
 					elif cheat == "items":
 						for item in item_type_list:
 							w.player.inventory[item] = 50
 					elif cheat == "aggro":
 						for m in w.monsters:
 							m.aggro = True
+						w.monster_scheduler.wake_all()
 					elif cheat == "unaggro":
 						for m in w.monsters:
 							m.aggro = False
@@ -2162,10 +3034,155 @@ class Game:
 						w.player.xp = w.player.max_xp
 						w.player.check_for_level_up()
 						
-try:
-	stdscr = curses.initscr()
-	curses.start_color()
-	color_mapping = {}
+def make_world(coarse_w, coarse_h, quick=False, adam_style=None):
+	# Build a new world and make it the current one.
+	# The global has to be set first, because world generation refers back to it. (e.g., to place enemies)
+	global w
+	w = World(coarse_w, coarse_h)
+	if quick:
+		w.build_world_abridged()
+	else:
+		w.build_world(adam_style)
+	return w
+
+# Saved games are snapshots. (See snapshot.py) Per-cell tables, such as the step counts, are stored
+# as two arrays: the cells in the table (as indices, like in a Grid) and their values.
+CELL_TABLES = ["steps", "steps_doors_dont_count", "visible_count"]
+PLAYER_FIELDS = ["gold", "level", "xp", "max_xp", "hp", "max_hp", "mp", "max_mp", "stun"]
+THING_KINDS = [Chest, Bloodstone]
+# The paths shown by the "path" cheat, saved as lists of cells.
+PATH_FIELDS = ["shortest_winning_path", "shortest_doorless_path"]
+
+def save_world(world, path):
+	# Save the world, along with the player, monsters and hidden enemies in it.
+	# Item and enemy types are saved by name, and the names are stored once, in the "names" section.
+	out = snapshot.Writer()
+	names, name_index = [], {}
+	def name(s):
+		if s not in name_index:
+			name_index[s] = len(names)
+			names.append(s)
+		return name_index[s]
+	cells, width = world.cells, world.w
+	out.add_ints("world", [world.coarse_w, world.coarse_h] + list(world.start_loc) + list(world.dest_loc))
+	out.add_bytes("basic", cells.basic)
+	for table in CELL_TABLES:
+		entries = sorted((y*width+x, value) for (x, y), value in getattr(world, table).iteritems())
+		out.add_ints(table + ".cells", [index for index, value in entries])
+		out.add_ints(table + ".values", [value for index, value in entries])
+	out.add_ints("steps_skipped", [n for item in sorted(cells.steps_skipped.iteritems()) for n in item])
+	out.add_ints("revealed", world.revealed.indices())
+	# Each door is saved as its cell, followed by the cells on its two sides.
+	out.add_ints("doors", [y*width+x for xy, sides in world.doors for x, y in [xy] + sides])
+	for field in PATH_FIELDS:
+		out.add_ints(field, [y*width+x for x, y in getattr(world, field)])
+	# Things are saved as their cell and kind, followed by their state.
+	things = []
+	for index in sorted(cells.contents):
+		for thing in cells.contents[index]:
+			things += [index, THING_KINDS.index(thing.__class__), thing.should_cull]
+			if isinstance(thing, Chest):
+				things += [thing.is_super, thing.gold_content, len(thing.inventory)]
+				for itemtype, count in thing.inventory.iteritems():
+					things += [name(itemtype.name), count]
+	out.add_ints("things", things)
+	p = world.player
+	out.add_ints("player", list(p.xy) + [getattr(p, field) for field in PLAYER_FIELDS])
+	out.add_array("player_fractions", "d", [p.fractional_mp])
+	out.add_ints("inventory", [n for itemtype, count in p.inventory.iteritems() for n in (name(itemtype.name), count)])
+	monsters = []
+	for m in world.monsters:
+		monsters += [name(m.__class__.__name__), m.xy[0], m.xy[1], m.hp, m.stun, m.aggro, m.can_deaggro, m.moved_this_round]
+	out.add_ints("monsters", monsters)
+	hidden = []
+	for dynamic in world.dynamic_objects:
+		if not isinstance(dynamic, HiddenEnemy):
+			raise ValueError("Can't save a %s" % dynamic.__class__.__name__)
+		hidden += [name(dynamic.enemy_type.__name__), dynamic.xy[0], dynamic.xy[1], dynamic.steps_required_to_unhide, dynamic.do_cull]
+	out.add_ints("hidden_enemies", hidden)
+	out.add_bytes("names", "\n".join(names))
+	out.write(path)
+
+def load_world(path):
+	# Load a world saved with save_world, and make it the current one.
+	global w
+	snap = snapshot.Reader(path)
+	# Loading makes tens of thousands of tuples in one go, which would set off the garbage collector over and over.
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		names = str(snap.get_bytes("names")).split("\n")
+		item_types = dict((itemtype.name, itemtype) for itemtype in item_type_list)
+		enemy_types = dict((cls.__name__, cls) for cls in enemy_type_distribution)
+		coarse_w, coarse_h, start_x, start_y, dest_x, dest_y = snap.get_array("world")
+		w = World(coarse_w, coarse_h)
+		w.start_loc, w.dest_loc = (start_x, start_y), (dest_x, dest_y)
+		w.visible_memo = VisibilityCache(w.VISIBLE_MEMO_SIZE)
+		w.cells = cells = Grid(w.w, w.h)
+		# (A copy of the mapped bytes: the grid is changed as the game goes on, and is read as ints.)
+		cells.basic = snap.get_bytes("basic")
+		xys = [(x, y) for y in xrange(w.h) for x in xrange(w.w)]
+		for table in CELL_TABLES:
+			setattr(w, table, dict(itertools.izip(itertools.imap(xys.__getitem__, snap.get_array(table + ".cells")), snap.get_array(table + ".values"))))
+		pairs = snap.get_array("steps_skipped")
+		cells.steps_skipped = dict(zip(pairs[::2], pairs[1::2]))
+		w.revealed = CellSet(w.w, w.h, itertools.imap(xys.__getitem__, snap.get_array("revealed")))
+		cells_of = map(xys.__getitem__, snap.get_array("doors"))
+		w.doors = [(cells_of[i], cells_of[i+1:i+3]) for i in xrange(0, len(cells_of), 3)]
+		for field in PATH_FIELDS:
+			setattr(w, field, map(xys.__getitem__, snap.get_array(field)))
+		things, i = snap.get_array("things"), 0
+		while i < len(things):
+			index, kind, should_cull = things[i:i+3]
+			thing = THING_KINDS[kind]()
+			thing.should_cull = bool(should_cull)
+			i += 3
+			if kind == THING_KINDS.index(Chest):
+				thing.is_super, thing.gold_content, count = bool(things[i]), things[i+1], things[i+2]
+				thing.inventory = dict((item_types[names[n]], c) for n, c in zip(things[i+3:i+3+2*count:2], things[i+4:i+4+2*count:2]))
+				i += 3 + 2*count
+			cells.contents.setdefault(index, []).append(thing)
+		w.player = p = Player()
+		values = snap.get_array("player")
+		p.xy = values[0], values[1]
+		for field, value in zip(PLAYER_FIELDS, values[2:]):
+			setattr(p, field, value)
+		p.fractional_mp, = snap.get_array("player_fractions")
+		pairs = snap.get_array("inventory")
+		p.inventory = dict((item_types[names[n]], count) for n, count in zip(pairs[::2], pairs[1::2]))
+		values = snap.get_array("monsters")
+		for i in xrange(0, len(values), 8):
+			type_name, x, y, hp, stun, aggro, deaggro, moved = values[i:i+8]
+			m = enemy_types[names[type_name]]((x, y))
+			m.hp, m.stun, m.aggro, m.can_deaggro, m.moved_this_round = hp, stun, bool(aggro), bool(deaggro), bool(moved)
+			w.add_monster(m)
+		values = snap.get_array("hidden_enemies")
+		for i in xrange(0, len(values), 5):
+			type_name, x, y, steps_required, do_cull = values[i:i+5]
+			hidden = HiddenEnemy((x, y), enemy_types[names[type_name]], steps_required)
+			if do_cull:
+				hidden.do_cull = True
+			w.add_dynamic_object(hidden)
+		cells.on_change = w.tile_changed
+		w.full_rerender()
+	finally:
+		snap.close()
+		if gc_was_enabled:
+			gc.enable()
+	return w
+
+def setup_headless(keys=(), size=(24, 80)):
+	# Run the engine without a terminal: nothing is drawn, animations don't wait,
+	# and input is read from keys (a sequence of key codes or single characters) instead of the keyboard.
+	global headless, stdscr, world_pad, info_pane, screen_height, screen_width, g
+	headless = True
+	stdscr = world_pad = info_pane = NullScreen(keys, size)
+	screen_height, screen_width = size
+	g = Game()
+	g.layout()
+	return g
+
+def init_colors():
 	def c(name, fg, bg):
 		i = len(color_mapping) + 1
 		color_mapping[name] = i
@@ -2179,13 +3196,60 @@ try:
 	c(yellow, curses.COLOR_YELLOW, curses.COLOR_BLACK)
 	c(foggy, curses.COLOR_BLACK, curses.COLOR_WHITE)
 	c(player_color, curses.COLOR_BLACK, curses.COLOR_CYAN)
-	curses.noecho()
-	curses.cbreak()
-	curses.curs_set(0)
-	stdscr.keypad(1)
-	g = Game()
-	g.main_loop(stdscr)
-finally:
-	curses.nocbreak(); stdscr.keypad(0); curses.echo()
-	curses.endwin()
 
+def file_digest(path):
+	with open(path, "rb") as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def get_option(name, default=None):
+	# Get the value following a command line flag, e.g., get_option("--seed") for "--seed 1234".
+	if name in sys.argv[:-1]:
+		return sys.argv[sys.argv.index(name)+1]
+	return default
+
+# What --profile times.
+PROFILED_METHODS = [
+	(World, "build_world"),
+	(World, "time_step"),
+	(World, "build_pathing_map"),
+	(World, "visible_set"),
+	(World, "pprint"),
+	(Game, "refresh_screen"),
+]
+
+# Flags that change how the world is built, which a recording has to remember.
+WORLD_FLAGS = ["--quick", "--adam-style", "--shadowcast"]
+
+def main():
+	global stdscr, g, key_log
+	# Seed the random number generator, so that a game can be reproduced.
+	seed = int(get_option("--seed", random.randrange(2**31)))
+	random.seed(seed)
+	if get_option("--profile"):
+		profiler.enable()
+	if get_option("--record"):
+		key_log = open(get_option("--record"), "w")
+		key_log.write("# magic-maze key recording, replay with replay.py\n")
+		key_log.write("# seed %i\n" % seed)
+		key_log.write("# flags %s\n" % " ".join(flag for flag in WORLD_FLAGS if flag in sys.argv))
+		if get_option("--load"):
+			# The game starts from a saved world, so the replay needs that same world. (The digest tells if it has changed since.)
+			key_log.write("# load %s %s\n" % (file_digest(get_option("--load")), os.path.abspath(get_option("--load"))))
+	try:
+		stdscr = curses.initscr()
+		curses.start_color()
+		init_colors()
+		curses.noecho()
+		curses.cbreak()
+		curses.curs_set(0)
+		stdscr.keypad(1)
+		g = Game()
+		g.main_loop(stdscr if key_log is None else RecordingScreen(stdscr))
+	finally:
+		curses.nocbreak(); stdscr.keypad(0); curses.echo()
+		curses.endwin()
+		if get_option("--profile"):
+			profiler.write(get_option("--profile"))
+
+if __name__ == "__main__":
+	main()
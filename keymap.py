@@ -9,9 +9,8 @@ key should be a single character, except it may be surrounded by quotes. (This i
 
 import os 
 
-# Make sure we're in the correct directory
+# Mapping files live next to this module, regardless of the working directory.
 _mydir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(_mydir)
 
 keymap = dict()
 
@@ -24,10 +23,10 @@ def add_mappings(f):
 			key = key[1]
 		keymap[cmd.strip()] = ord(key)
 
-with open("keyboard_mappings.default",'r') as f:
+with open(os.path.join(_mydir, "keyboard_mappings.default"),'r') as f:
 	add_mappings(f)
 try:
-	with open("keyboard_mappings",'r') as f:
+	with open(os.path.join(_mydir, "keyboard_mappings"),'r') as f:
 		add_mappings(f)
 except IOError:
 	# No user keyboard mappings overriding the defaults. No problem!
@@ -0,0 +1,55 @@
+"""
+npgen.py: NumPy versions of the whole-map passes of world generation.
+
+These work on the same game.Grid and Tile.PASSABLE tables as the plain versions (in pathing.py and World.build_world),
+and give exactly the same results, in the same order, so that worlds come out the same for a given seed either way.
+Nothing here draws random numbers: the passes that do (carving the maze, placing glass) stay in plain Python.
+
+game.py only uses this module if NumPy can be imported.
+"""
+
+import numpy as np
+
+def passable_array(grid, passable):
+	# A flat boolean array saying which cells of the grid are passable.
+	return np.array(passable, dtype=bool)[np.frombuffer(grid.basic, dtype=np.uint8)]
+
+def match_patterns(grid, passable, patterns):
+	# Returns the interior cells whose 3x3 neighborhood matches one of the patterns, in the order x-major, then y.
+	# A pattern is a list of 9 booleans (True means passable), ordered by dx, then dy, like in World.TRIM_OPERATIONS.
+	w, h = grid.w, grid.h
+	cells = passable_array(grid, passable).reshape(h, w)
+	# Encode each neighborhood as a 9 bit number, and look the numbers up in a table of the wanted ones.
+	code = np.zeros((h-2, w-2), dtype=np.int16)
+	for bit in xrange(9):
+		dx, dy = bit / 3 - 1, bit % 3 - 1
+		code |= cells[1+dy:h-1+dy, 1+dx:w-1+dx].astype(np.int16) << bit
+	wanted = np.zeros(512, dtype=bool)
+	for pattern in patterns:
+		wanted[sum(1 << bit for bit, p in enumerate(pattern) if p)] = True
+	xs, ys = np.nonzero(wanted[code].T)
+	return zip((xs+1).tolist(), (ys+1).tolist())
+
+def step_counts(grid, passable, start):
+	# Same as pathing.step_counts, but expands a whole frontier of the search at a time.
+	# The cells are added to the dict in the order the plain search would add them, so it iterates in the same order.
+	width = grid.w
+	open_cells = passable_array(grid, passable)
+	steps = np.full(len(open_cells), -1, dtype=np.int32)
+	offsets = np.array([-1, 1, -width, width])
+	frontier = np.array([start[1]*width + start[0]])
+	steps[frontier] = 0
+	order = [frontier]
+	count = 0
+	while frontier.size:
+		count += 1
+		# Neighbors in the order they would be queued: by frontier cell, then by offset.
+		reached = (frontier[:, None] + offsets).ravel()
+		reached = reached[open_cells[reached] & (steps[reached] < 0)]
+		# A cell can be reached from two sides, but only the first counts.
+		reached, first = np.unique(reached, return_index=True)
+		frontier = reached[np.argsort(first)]
+		steps[frontier] = count
+		order.append(frontier)
+	order = np.concatenate(order)
+	return dict(zip(zip((order % width).tolist(), (order / width).tolist()), steps[order].tolist()))
@@ -0,0 +1,95 @@
+"""
+pathing.py: Breadth first searches over the world grid.
+
+These are plain single threaded searches on collections.deque. (Queue.Queue, which this replaces,
+takes a lock on every put and get.) Each cell is queued at most once, by marking it when it is first reached.
+
+The grid is a game.Grid, and passable is one of the Tile.PASSABLE tables, indexed by tile type.
+"""
+
+import random
+from collections import deque
+
+# The same order as World.get_neighbors, so that shuffles consume randomness identically.
+NEIGHBOR_OFFSETS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+def step_counts(grid, passable, start):
+	# Returns a dict giving the number of steps needed to walk from start to each reachable cell.
+	basic, width = grid.basic, grid.w
+	steps = {start: 0}
+	queue = deque([start])
+	while queue:
+		x, y = xy = queue.popleft()
+		count = steps[xy] + 1
+		for dx, dy in NEIGHBOR_OFFSETS:
+			n = x+dx, y+dy
+			if n not in steps and passable[basic[n[1]*width+n[0]]]:
+				steps[n] = count
+				queue.append(n)
+	return steps
+
+def pathing_map(grid, passable, source, points_to_include, shuffle=random.shuffle):
+	# Returns a dict mapping each cell to the next cell on a shortest path to source. (source maps to None)
+	# The search stops once every point in points_to_include has been reached, so one map can route many points.
+	# Neighbors are shuffled as they are expanded, so that ties are broken randomly.
+	basic, width = grid.basic, grid.w
+	parent = {}
+	queue = deque([(None, source)])
+	seen = set([source])
+	points_to_include = set(points_to_include)
+	while points_to_include and queue:
+		prev, xy = queue.popleft()
+		parent[xy] = prev
+		points_to_include.discard(xy)
+		neighbors = [(xy[0]+dx, xy[1]+dy) for dx, dy in NEIGHBOR_OFFSETS]
+		shuffle(neighbors)
+		for n in neighbors:
+			if n not in seen and passable[basic[n[1]*width+n[0]]]:
+				seen.add(n)
+				queue.append((xy, n))
+	return parent
+
+def trace_path(parent, b):
+	# Follow a pathing map from b back to its source, giving the path from the source to b. (Both ends included.)
+	path = [b]
+	while path[-1] is not None:
+		path.append(parent[path[-1]])
+	return path[-2::-1]
+
+class DistanceField:
+	# Walking distances to a source, for routing many walkers towards it. (e.g., monsters to the player)
+	# The search behind it is only expanded as far as it has been asked about, so routing a few nearby
+	# walkers doesn't cost a search of the whole map, and a field can be kept as long as the source
+	# and the terrain stay the same.
+	def __init__(self, grid, passable, source, choice=random.choice):
+		self.grid, self.passable, self.source, self.choice = grid, passable, source, choice
+		self.dist = {source: 0}
+		self.queue = deque([source])
+
+	def reach(self, xy):
+		# Expand the search until xy is reached (returns True) or everything reachable has been found. (returns False)
+		basic, width, passable = self.grid.basic, self.grid.w, self.passable
+		dist, queue = self.dist, self.queue
+		while xy not in dist and queue:
+			x, y = cur = queue.popleft()
+			count = dist[cur] + 1
+			for dx, dy in NEIGHBOR_OFFSETS:
+				n = x+dx, y+dy
+				if n not in dist and passable[basic[n[1]*width+n[0]]]:
+					dist[n] = count
+					queue.append(n)
+		return xy in dist
+
+	def __contains__(self, xy):
+		return self.reach(xy)
+
+	def __getitem__(self, xy):
+		# Like a pathing map: the next cell to go to from xy on a shortest path to the source, chosen randomly among ties.
+		# None for the source itself.
+		if not self.reach(xy):
+			raise KeyError(xy)
+		count = self.dist[xy]
+		if count == 0:
+			return None
+		# Every cell one step closer was found before xy was, so its distance is already known.
+		return self.choice([(xy[0]+dx, xy[1]+dy) for dx, dy in NEIGHBOR_OFFSETS if self.dist.get((xy[0]+dx, xy[1]+dy)) == count-1])
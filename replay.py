@@ -0,0 +1,89 @@
+#! /usr/bin/python
+"""
+replay.py: Replay a recorded game headlessly, for deterministic benchmarks and regression checks.
+
+Record a game with:  python game.py --record game.keys
+Replay it with:      python replay.py game.keys [--seed N] [--profile report.json]
+
+A recording is a text file of key codes, one per line, with the random seed and the world
+building flags in "# seed" and "# flags" comment lines at the top. A game started with --load
+also has a "# load" line, giving the digest and path of the saved world, which the replay loads
+too. (It refuses to, if the world has changed since the recording.) The replay runs the game until
+the recorded keys run out, then reports turns per second, the time spent in World.time_step,
+World.pprint and World.see_from, and a hash of the final game state. (The timings are inclusive,
+so the pprint calls made while animating attacks during a time step count towards both.)
+Replaying the same recording on the same code always gives the same hash.
+With --profile, the game's own profiling report (see game.Profiler) is written out as well.
+"""
+
+import os, sys, time, random
+
+import game
+
+TIMED_METHODS = ["time_step", "pprint", "see_from"]
+
+def read_recording(path):
+	seed, flags, load, keys = None, [], None, []
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if line.startswith("#"):
+				words = line[1:].split()
+				if words[:1] == ["seed"]:
+					seed = int(words[1])
+				elif words[:1] == ["flags"]:
+					flags = words[1:]
+				elif words[:1] == ["load"]:
+					# The path can have spaces in it, so it is everything after the digest.
+					digest, world_path = line[1:].split(None, 2)[1:]
+					load = digest, world_path
+			elif line:
+				keys.append(int(line))
+	return seed, flags, load, keys
+
+def replay(path, seed=None):
+	recorded_seed, flags, load, keys = read_recording(path)
+	if seed is None:
+		seed = recorded_seed or 0
+	sys.argv = sys.argv[:1] + flags
+	if load is not None:
+		digest, world_path = load
+		if not os.path.exists(world_path) or game.file_digest(world_path) != digest:
+			raise ValueError("%s was recorded on the saved world %s, which is missing or has changed since" % (path, world_path))
+		sys.argv += ["--load", world_path]
+	game.setup_headless(keys)
+	# The game's profiler does the timing. (With --profile, the methods it times anyway aren't wrapped twice.)
+	watched = dict((name, game.profiler.watch(game.World, name)) for name in TIMED_METHODS)
+	random.seed(seed)
+	start = time.time()
+	try:
+		game.g.main_loop(game.stdscr)
+	except game.HeadlessInputExhausted:
+		# Out of recorded keys: the replay is over.
+		pass
+	elapsed = time.time() - start
+	stats = dict((name, game.profiler.stats.get(key, [0, 0.0])) for name, key in watched.iteritems())
+	return seed, len(keys), elapsed, stats, game.w.state_digest()
+
+def main():
+	if len(sys.argv) < 2:
+		print __doc__
+		sys.exit(1)
+	seed = game.get_option("--seed")
+	profile = game.get_option("--profile")
+	if profile:
+		game.profiler.enable()
+	seed, key_count, elapsed, stats, digest = replay(sys.argv[1], None if seed is None else int(seed))
+	turns = stats["time_step"][0]
+	print "Replayed %i keys (seed %i) in %.3fs" % (key_count, seed, elapsed)
+	print "  turns: %i (%.1f turns/sec)" % (turns, turns / elapsed if elapsed else 0.0)
+	for name in TIMED_METHODS:
+		calls, total = stats[name]
+		print "  %-10s %6i calls %9.3fs total %9.3f ms/call" % (name, calls, total, 1e3 * total / calls if calls else 0.0)
+	print "  final state: %s" % digest
+	if profile:
+		game.profiler.write(profile)
+		print "  profile written to %s" % profile
+
+if __name__ == "__main__":
+	main()
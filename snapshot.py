@@ -0,0 +1,95 @@
+"""
+snapshot.py: A compact binary container, used for saved games.
+
+A snapshot is a header, a table of named sections, and the sections themselves. A section is either raw bytes,
+or a flat array of numbers (anything the array module handles, stored little-endian). Sections start on 8 byte
+boundaries, and a snapshot is read through a memory map, so getting at one section never reads the others.
+(Getting a section copies it out of the map, though, so it can be changed and outlives the Reader.)
+
+The layout is:
+	MAGIC, then the format version and the number of sections, as two little-endian uint32s.
+	For each section: its name (32 bytes, zero padded), its array typecode (or "B" for raw bytes), its offset and its length.
+	The section data.
+What goes in the sections is up to the caller. (See game.save_world.)
+"""
+
+import mmap, struct, sys
+from array import array
+
+MAGIC = "MMAZESNP"
+# Version 2 added the doors and the shortest paths to saved worlds.
+VERSION = 2
+HEADER = struct.Struct("<8sII")
+ENTRY = struct.Struct("<32scxxxxxxxQQ")
+
+class Writer:
+	def __init__(self):
+		self.sections = []
+
+	def add_bytes(self, name, data):
+		self.sections.append((name, "B", str(data)))
+
+	def add_array(self, name, typecode, values):
+		values = array(typecode, values)
+		if sys.byteorder == "big":
+			values.byteswap()
+		self.sections.append((name, typecode, values.tostring()))
+
+	def add_ints(self, name, values):
+		# An array of integers (or bools), in the smallest signed type that holds them all.
+		values = [int(v) for v in values]
+		low, high = min(values or [0]), max(values or [0])
+		for typecode in "bhi":
+			limit = 1 << (8*array(typecode).itemsize - 1)
+			if -limit <= low and high < limit:
+				break
+		self.add_array(name, typecode, values)
+
+	def write(self, path):
+		offset = HEADER.size + ENTRY.size * len(self.sections)
+		table, blobs = [], []
+		for name, typecode, data in self.sections:
+			if len(name) > 32:
+				raise ValueError("Section name too long: %r" % name)
+			offset += -offset % 8
+			table.append(ENTRY.pack(name, typecode, offset, len(data)))
+			blobs.append((offset, data))
+			offset += len(data)
+		with open(path, "wb") as f:
+			f.write(HEADER.pack(MAGIC, VERSION, len(self.sections)))
+			f.write("".join(table))
+			for offset, data in blobs:
+				f.write("\0" * (offset - f.tell()))
+				f.write(data)
+
+class Reader:
+	def __init__(self, path):
+		with open(path, "rb") as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, count = HEADER.unpack_from(self.map)
+		if magic != MAGIC:
+			raise ValueError("%s is not a snapshot" % path)
+		if version != VERSION:
+			raise ValueError("%s has snapshot format version %i, but only version %i is supported" % (path, version, VERSION))
+		self.sections = {}
+		for i in xrange(count):
+			name, typecode, offset, length = ENTRY.unpack_from(self.map, HEADER.size + i*ENTRY.size)
+			self.sections[name.rstrip("\0")] = typecode, offset, length
+
+	def __contains__(self, name):
+		return name in self.sections
+
+	def get_bytes(self, name):
+		typecode, offset, length = self.sections[name]
+		return bytearray(self.map[offset:offset+length])
+
+	def get_array(self, name):
+		typecode, offset, length = self.sections[name]
+		values = array(typecode)
+		values.fromstring(self.map[offset:offset+length])
+		if sys.byteorder == "big":
+			values.byteswap()
+		return values
+
+	def close(self):
+		self.map.close()
@@ -0,0 +1,57 @@
+"""
+test_save_load.py: Check that a saved world loads back into one the game can carry on with.
+
+Run with: python -m unittest discover tests
+"""
+
+import os, sys, random, shutil, struct, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import game
+from keymap import keymap
+
+class SaveLoadTest(unittest.TestCase):
+	def setUp(self):
+		self.argv = sys.argv
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, "test.world")
+
+	def tearDown(self):
+		sys.argv = self.argv
+		shutil.rmtree(self.dir)
+
+	def build_and_save(self):
+		game.setup_headless()
+		random.seed(3)
+		world = game.make_world(20, 15)
+		game.save_world(world, self.path)
+		return world
+
+	def test_round_trip(self):
+		world = self.build_and_save()
+		loaded = game.load_world(self.path)
+		self.assertEqual(world.state_digest(), loaded.state_digest())
+		for field in ["doors"] + game.PATH_FIELDS:
+			self.assertEqual(getattr(world, field), getattr(loaded, field))
+
+	def test_old_version_rejected(self):
+		# Worlds saved by an older version of the format don't have everything a game needs.
+		self.build_and_save()
+		with open(self.path, "r+b") as f:
+			f.seek(len(game.snapshot.MAGIC))
+			f.write(struct.pack("<I", game.snapshot.VERSION - 1))
+		self.assertRaises(ValueError, game.load_world, self.path)
+
+	def test_path_cheat_after_load(self):
+		# Play a loaded game with the "path" cheat on, so that the shortest paths get drawn.
+		self.build_and_save()
+		sys.argv = ["game.py", "--load", self.path]
+		game.setup_headless(chr(keymap["rare_cmd"]) + "cheat\npath\n" + chr(keymap["wait"]))
+		try:
+			game.g.main_loop(game.stdscr)
+		except game.HeadlessInputExhausted:
+			pass
+		self.assertTrue(game.w.print_paths)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,59 @@
+#! /usr/bin/python
+"""
+worldfarm.py: Build many worlds in parallel, and save them to disk.
+
+Usage: python worldfarm.py OUTDIR [--seeds FIRST:LAST] [--size WxH] [--adam-style] [--processes N]
+
+Each seed from FIRST up to (but not including) LAST gives one world, of coarse size WxH. (35x25 by default, like the game.)
+A world is built exactly as "python game.py --seed SEED" would build it, so a seed can be played after the fact.
+The worlds are built across N worker processes (by default, one per CPU core), and each one is saved to
+OUTDIR/world-STYLE-WxH-SEED.world, where STYLE is snp or adam. Load them back with game.load_world.
+"""
+
+import os, sys, time, random, multiprocessing
+
+import game
+
+def build(job):
+	# Build and save one world. This runs in a worker process.
+	seed, coarse_w, coarse_h, adam_style, path = job
+	start = time.time()
+	random.seed(seed)
+	world = game.make_world(coarse_w, coarse_h, adam_style=adam_style)
+	game.save_world(world, path)
+	return seed, path, time.time() - start, world.state_digest()
+
+def world_path(outdir, seed, coarse_w, coarse_h, adam_style):
+	return os.path.join(outdir, "world-%s-%ix%i-%i.world" % ("adam" if adam_style else "snp", coarse_w, coarse_h, seed))
+
+def farm(outdir, seeds, coarse_w, coarse_h, adam_style=False, processes=None):
+	# Build a world for each seed, yielding (seed, path, build time, state digest) as each one is finished.
+	if not os.path.isdir(outdir):
+		os.makedirs(outdir)
+	jobs = [(seed, coarse_w, coarse_h, adam_style, world_path(outdir, seed, coarse_w, coarse_h, adam_style)) for seed in seeds]
+	# World generation draws its loading screen on the global curses screen, so the workers run headless.
+	pool = multiprocessing.Pool(processes, game.setup_headless)
+	try:
+		for result in pool.imap_unordered(build, jobs):
+			yield result
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def main():
+	if len(sys.argv) < 2 or sys.argv[1].startswith("--"):
+		print __doc__
+		sys.exit(1)
+	first, last = map(int, game.get_option("--seeds", "0:%i" % multiprocessing.cpu_count()).split(":"))
+	coarse_w, coarse_h = map(int, game.get_option("--size", "35x25").split("x"))
+	processes = game.get_option("--processes")
+	adam_style = "--adam-style" in sys.argv
+	start = time.time()
+	for seed, path, elapsed, digest in farm(sys.argv[1], xrange(first, last), coarse_w, coarse_h, adam_style,
+			None if processes is None else int(processes)):
+		print "seed %i: built in %.2fs, saved to %s (state %s)" % (seed, elapsed, path, digest)
+	print "Built %i worlds in %.2fs" % (last - first, time.time() - start)
+
+if __name__ == "__main__":
+	main()